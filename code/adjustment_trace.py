@@ -0,0 +1,72 @@
+from __future__ import division
+import os
+import time
+import numpy as np
+
+# Binary traces of the match luminance adjustments in experiment.py. Every
+# button press and every change of the display is appended to the trace file
+# of the session as one fixed size record, so a trace can be read back as a
+# structured array with a single np.frombuffer call.
+
+buttons = (None, 'Up', 'Right', 'Down', 'Left', 'Space')
+displays = ('match', 'stimulus', 'confirmation')
+
+record_dtype = np.dtype([('time', '<f8'), ('trial', '<i4'),
+    ('match_lum', '<f4'), ('button', 'u1'), ('display', 'u1')])
+
+class TraceWriter(object):
+    """Buffered, append-only writer of trace records. Records are collected
+    in memory and written when the buffer is full or on flush(), e.g. at the
+    end of a trial."""
+
+    def __init__(self, trace_fn, buffer_size=1024):
+        trace_dir = os.path.dirname(trace_fn)
+        if trace_dir and not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir)
+        self.trace_file = open(trace_fn, 'ab')
+        self.buffer = np.zeros(buffer_size, dtype=record_dtype)
+        self.n_records = 0
+        self.trial = -1
+
+    def log(self, display, match_lum, button=None, t=None):
+        """Record the display state and match luminance after a button press
+        or a change of the display, at time t (default: now)."""
+        if self.n_records == len(self.buffer):
+            self.flush()
+        record = self.buffer[self.n_records]
+        record['time'] = time.time() if t is None else t
+        record['trial'] = self.trial
+        record['match_lum'] = match_lum
+        record['button'] = buttons.index(button)
+        record['display'] = displays.index(display)
+        self.n_records += 1
+
+    def flush(self):
+        self.trace_file.write(self.buffer[:self.n_records].tobytes())
+        self.trace_file.flush()
+        self.n_records = 0
+
+    def close(self):
+        self.flush()
+        self.trace_file.close()
+
+def read_trace(trace_fn):
+    """Read a trace file as a structured array with fields time, trial,
+    match_lum, button and display (the latter two index buttons and
+    displays). A record that was only partially written, e.g. in a crash, is
+    dropped."""
+    with open(trace_fn, 'rb') as f:
+        data = f.read()
+    n_records = len(data) // record_dtype.itemsize
+    return np.frombuffer(data, dtype=record_dtype, count=n_records)
+
+def split_trials(records):
+    """Split the records of a trace into a dict that maps trial numbers to
+    the records of the trial"""
+    order = np.argsort(records['trial'], kind='mergesort')
+    trial_nrs = records['trial'][order]
+    trials = np.unique(trial_nrs)
+    starts = np.searchsorted(trial_nrs, trials, side='left')
+    ends = np.searchsorted(trial_nrs, trials, side='right')
+    return dict((trial, records[order[start:end]]) for trial, start, end in
+            zip(trials, starts, ends))
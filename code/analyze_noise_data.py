@@ -4,15 +4,21 @@
 from __future__ import division
 import os
 import numpy as np
-import matplotlib
-import lmfit
-import matplotlib.pyplot as plt
-from ocupy import datamat
-from scipy.stats.stats import pearsonr
-from scipy.optimize import curve_fit
-from scipy import interpolate
 
+import lazy
 import evaluate_models
+import result_store
+import illusion
+import fit_cache
+import bootstrap
+import gaussian_fit
+import figures
+
+# plotting and statistics modules are only imported when they are used
+matplotlib = lazy.LazyModule('matplotlib')
+plt = lazy.LazyModule('matplotlib.pyplot')
+stats = lazy.LazyModule('scipy.stats')
+interpolate = lazy.LazyModule('scipy.interpolate')
 
 global grating_frequencies
 grating_frequencies = {.1: .103,#.098,
@@ -83,38 +89,34 @@ def get_all_data(exp_type='fast', vp_names=None, clean=False):
     if vp_names is None:
         vp_names = [vp_name for vp_name in os.listdir(datadir) if os.path.isdir(
                     os.path.join(datadir, vp_name))]
-    all_data = []
-    for vp in vp_names:
+    filenames = []
+    vps = []
+    for vp in sorted(vp_names):
         grating_freqs = os.listdir(os.path.join(datadir, vp))
-        for sf in grating_freqs:
+        for sf in sorted(grating_freqs):
             contrasts = os.listdir(os.path.join(datadir, vp, sf))
-            for contrast in contrasts:
-                filenames = os.listdir(os.path.join(datadir, vp, sf, contrast))
-                data = datamat.CsvFactory(os.path.join(datadir, vp, sf,
-                    contrast, filenames[0]))
-                for filename in filenames[1:]:
-                    data.join(datamat.CsvFactory(os.path.join(datadir, vp, sf,
-                        contrast, filename)))
-                data.add_field('vp', [vp] * len(data))
-                # convert luminance encoding to cd/m^2
-                data.match_lum *= 88
-                data.match_initial *= 88
-                data.test_lum *= 88
-                if clean:
-                    data = data[~mark_outliers(data)]
-                all_data.append(data)
-    # combine datamats
-    data = all_data[0]
-    for this_data in all_data[1:]:
-        data.join(this_data)
-    data.add_parameter('exp_type', exp_type + '_matching')
+            for contrast in sorted(contrasts):
+                for filename in sorted(os.listdir(os.path.join(datadir, vp,
+                        sf, contrast))):
+                    filenames.append(os.path.join(datadir, vp, sf, contrast,
+                        filename))
+                    vps.append(vp)
+    records = result_store.load(filenames, 'exp_data', labels={'vp': vps})
+    data = result_store.to_datamat(records,
+            {'exp_type': exp_type + '_matching'})
+    # convert luminance encoding to cd/m^2
+    data.match_lum *= 88
+    data.match_initial *= 88
+    data.test_lum *= 88
+    if clean:
+        data = data[~mark_outliers(data)]
     return data
 
 def start_val_correlations(vp, data):
     # create start_lum vs end_lum scatter plots
     fig = plt.figure(figsize=(3,3))
     plt.plot(data.match_initial, data.match_lum, '.k')
-    plt.title('r=%.3f, p=%.3f' % pearsonr(data.match_initial,
+    plt.title('r=%.3f, p=%.3f' % stats.pearsonr(data.match_initial,
         data.match_lum))
     plt.ylim((.3*88, .7*88))
     plt.xlim((.3*88, .7*88))
@@ -127,18 +129,7 @@ def start_val_correlations(vp, data):
 def compute_illusion_strength(data):
     """Compute illusion strength for all noise frequencies. Data should be
     appropriately filtered (one type of noise, one subject)"""
-    noise_frequencies = np.unique(data.noise_freq)
-    n_freqs = len(noise_frequencies)
-    n_reps = len(np.unique(data.rep))
-    illusion_strength = np.empty((n_freqs, n_reps))
-    for i, data_by_nf in enumerate(data.by_field('noise_freq')):
-        increments = [d.match_lum for d in
-            data_by_nf[data_by_nf.coaxial_lum == -1].by_field('rep')]
-        decrements = [d.match_lum for d in
-            data_by_nf[data_by_nf.coaxial_lum == 1].by_field('rep')]
-        illusion_strength[i, :] = np.asarray(increments).flatten() - \
-                                  np.asarray(decrements).flatten()
-    return illusion_strength
+    return illusion.compute_illusion_strength(data)
 
 def inverted_gaussian(x, center, baseline, width, minimum):
     x = np.log(x)
@@ -147,36 +138,65 @@ def inverted_gaussian(x, center, baseline, width, minimum):
     return baseline - (baseline - minimum) * np.exp(
             -(x - center) ** 2 / width ** 2)
 
-def fit_gaussian(data, constrained=False):
-    illusion_strength = compute_illusion_strength(data)
-    noise_frequencies = np.unique(data.noise_freq)
-    n_reps = illusion_strength.shape[1]
+def fit_gaussian(data, constrained=False, strength=None):
+    """Fit an inverted Gaussian to the illusion strength in data. strength can
+    be given as (noise_frequencies, illusion_strength) if it is already
+    computed. Fits are cached, see fit_cache.py."""
+    if strength is None:
+        strength = illusion.illusion_strengths(data, ())[()]
+    noise_frequencies, illusion_strength = strength
+    return fit_cache.cached_fit('analyze_noise_data.fit_gaussian', strength,
+            {'constrained': constrained}, inverted_gaussian,
+            lambda: fit_illusion_strength(noise_frequencies,
+                illusion_strength, constrained), gaussian_fit.fitter)
+
+def fit_illusion_strength(noise_frequencies, illusion_strength, constrained,
+        init=None):
+    """Fit an inverted Gaussian or, if there is no real dip, a horizontal line
+    to the illusion strength. init can give the starting values of the
+    inverted Gaussian, e.g. the best values of a previous fit, in which case
+    the inverted Gaussian is always fitted."""
+    return fit_illusion_strengths(noise_frequencies,
+            illusion_strength[np.newaxis], constrained, init)[0]
+
+def fit_illusion_strengths(noise_frequencies, illusion_strengths, constrained,
+        init=None):
+    """Fit each of the illusion strengths (shape (n_sets, n_freqs, n_reps))
+    like fit_illusion_strength, all at once with gaussian_fit. Returns a list
+    of fit_cache.FitResult."""
+    n_sets, n_freqs, n_reps = illusion_strengths.shape
+    means = illusion_strengths.mean(2)
     # fit a horizontal line if the data do not have any real dip
     # approximate baseline as 3rd largest value
-    baseline = np.sort(illusion_strength.mean(1))[-2]
-    minimum = illusion_strength.mean(1).min()
-    if baseline - minimum < illusion_strength.mean(1).max() - baseline:
-        model = lmfit.Model(lambda x, baseline: baseline)
-        params = lmfit.Parameters()
-        params.add('baseline', value=baseline)
+    baseline = np.sort(means, 1)[:, -2]
+    minimum = means.min(1)
+    if init is not None:
+        dip = np.ones(n_sets, dtype=bool)
+        start = np.tile([init[param] for param in gaussian_fit.params],
+                (n_sets, 1))
     else:
-        params = lmfit.Parameters()
-        #params.add('center', value=3)
-        params.add('center',
-                value=noise_frequencies[np.argmin(illusion_strength.mean(1))],
-                max=9, min=.5)
-        params.add('width', value=2)
+        dip = baseline - minimum >= means.max(1) - baseline
+        center = noise_frequencies[np.argmin(means, 1)]
         if constrained:
-            params.add('baseline', value=baseline)
-            params.add('minimum', value=minimum, min=minimum-1, max=baseline+1)
+            start = np.column_stack([center, np.full(n_sets, 2.), baseline,
+                minimum])
         else:
-            params.add('baseline', value=5)
-            params.add('minimum', value=-2)
-        model = lmfit.Model(inverted_gaussian)
-    result = model.fit(illusion_strength.ravel(),
-                       x=noise_frequencies.repeat(n_reps),
-                       params=params)
-    return result
+            start = np.column_stack([center, np.full(n_sets, 2.),
+                np.full(n_sets, 5.), np.full(n_sets, -2.)])
+    lower = np.tile([.5, -np.inf, -np.inf, -np.inf], (n_sets, 1))
+    upper = np.tile([9, np.inf, np.inf, np.inf], (n_sets, 1))
+    if constrained:
+        lower[:, 3] = minimum - 1
+        upper[:, 3] = baseline + 1
+    y = illusion_strengths.reshape((n_sets, -1))
+    fits = [fit_cache.FitResult(inverted_gaussian,
+        {'baseline': float(values.mean())}) for values in y]
+    best_params = gaussian_fit.fit(noise_frequencies.repeat(n_reps), y[dip],
+            start[dip], lower[dip], upper[dip], minimum_sign=-1)
+    for i, best_values in zip(np.flatnonzero(dip),
+            gaussian_fit.best_values(best_params)):
+        fits[i] = fit_cache.FitResult(inverted_gaussian, best_values)
+    return fits
 
 def plot_illusion_strength(data, baseline_data, ax, plot_xticks=True):
     """Plot strength of White's illusion per noise frequency"""
@@ -195,9 +215,9 @@ def plot_illusion_strength(data, baseline_data, ax, plot_xticks=True):
     ax.hlines(0, .1, .15, linestyles='solid', clip_on=False)
 
 
-    illusion_strength = compute_illusion_strength(data)
-    noise_frequencies = np.unique(data.noise_freq)
-    fit = fit_gaussian(data, constrained=True)
+    strength = illusion.illusion_strengths(data, ())[()]
+    noise_frequencies, illusion_strength = strength
+    fit = fit_gaussian(data, constrained=True, strength=strength)
     x_vals = np.linspace(.2, 10, 1000)
     ax.plot(x_vals, fit.eval(x=x_vals), color='.8', lw=3, zorder=1)
     #spline_fit = interpolate.UnivariateSpline(
@@ -284,24 +304,35 @@ def local_noise_illusion_strength(data):
     fig.savefig('../figures/illusion_strength_local_noise_%s.pdf' % (data.vp[0]))
     plt.close(fig)
 
-def local_noise_matches(data, highlight_unseen=False):
+def lightness_matches_figure(data, fig_fn, connected=False,
+        highlight_unseen=False):
+    """Create and save a figure of the lightness matches in data"""
+    fig, ax = plt.subplots(figsize=(5, 4))
+    plot_lightness_matches(ax, data, connected=connected,
+            highlight_unseen=highlight_unseen)
+    fig.savefig(fig_fn)
+    plt.close(fig)
+
+def local_noise_matches(data, highlight_unseen=False, processes=None):
     """Creates and saves figures of lightness matches in the local noise
-    condition for all subjects in data."""
+    condition for all subjects in data. Only figures whose data changed are
+    rendered, in parallel, see figures.py."""
     data = data[(data.noise_type == 'horizontal') | (data.noise_type ==
         'vertical')]
-    for vp_data in data.by_field('vp'):
-        for current_data in vp_data.by_field('noise_type'):
+    jobs = []
+    for vp in np.unique(data.vp):
+        for noise_type in np.unique(data[data.vp == vp].noise_type):
             for plot_lines in [0,1]:
-                fig, ax = plt.subplots(figsize=(5, 4))
-                plot_lightness_matches(ax, current_data, connected=plot_lines,
-                        highlight_unseen=highlight_unseen)
-                fig.savefig('../figures/'
+                jobs.append(figures.plot_job('../figures/'
                         '%s_lightness_matches_%s_%s.pdf' % (
-                            current_data.noise_type[0], ['', 'connected']
-                            [plot_lines], current_data.vp[0]))
-                plt.close(fig)
-
-def global_noise_illusion_strength(data):
+                            noise_type, ['', 'connected'][plot_lines], vp),
+                        lightness_matches_figure,
+                        [('vp', vp), ('noise_type', noise_type)],
+                        connected=plot_lines,
+                        highlight_unseen=highlight_unseen))
+    figures.build(jobs, data, processes)
+
+def global_noise_illusion_strength(data, fig_fn=None):
     """Create figure of illusion strength against noise frequency, for all
     grating frequencies, and including curve fits. Data should come from a
     single observer."""
@@ -332,66 +363,86 @@ def global_noise_illusion_strength(data):
         va='bottom', fontname='Helvetica', fontsize=12,
         transform=ax_xlab.transAxes)
     fig.subplots_adjust(left=.05, bottom=.05, top=.95, right=.95, wspace=.25)
-    fig.savefig('../figures/illusion_strength_global_noise_%s.pdf' %
-            (data.vp[0]))
+    if fig_fn is None:
+        fig_fn = '../figures/illusion_strength_global_noise_%s.pdf' % (
+                data.vp[0])
+    fig.savefig(fig_fn)
     plt.close(fig)
 
-def global_noise_matches(data, highlight_unseen=False):
+def global_noise_illusion_strengths(data, processes=None):
+    """Create the illusion strength figures of all observers in data. Only
+    figures whose data changed are rendered, in parallel, see figures.py."""
+    jobs = [figures.plot_job(
+                '../figures/illusion_strength_global_noise_%s.pdf' % vp,
+                global_noise_illusion_strength, [('vp', vp)])
+            for vp in np.unique(data.vp)]
+    figures.build(jobs, data, processes)
+
+def global_noise_matches(data, highlight_unseen=False, processes=None):
     """Creates and saves figures of lightness matches in the global noise
-    condition for all subjects in data."""
+    condition for all subjects in data. Only figures whose data changed are
+    rendered, in parallel, see figures.py."""
     #data = data[data.noise_type == 'global']
     if highlight_unseen:
         data.match_lum.mask = data.patch_visible == 0
-    for vp_data in data.by_field('vp'):
-        for contrast_data in vp_data.by_field('grating_contrast'):
-            for current_data in contrast_data.by_field('grating_freq'):
+    jobs = []
+    for vp in np.unique(data.vp):
+        vp_data = data[data.vp == vp]
+        for contrast in np.unique(vp_data.grating_contrast):
+            contrast_data = vp_data[vp_data.grating_contrast == contrast]
+            for grating_freq in np.unique(contrast_data.grating_freq):
                 for plot_lines in [0,1]:
-                    fig, ax = plt.subplots(figsize=(5, 4))
-                    plot_lightness_matches(ax, current_data, connected=plot_lines,
-                            highlight_unseen=highlight_unseen)
-                    fig.savefig('../figures/'
+                    jobs.append(figures.plot_job('../figures/'
                             '%slightness_matches%s_%1.1f_%s.pdf' %
                             (['', 'unseen_masked/'][int(highlight_unseen)],
                                 ['', '_connected'][plot_lines],
-                                current_data.grating_freq[0],
-                                current_data.vp[0]))
-                    plt.close(fig)
-
-def compute_slope(data):
-    """Compute the slope of the function relating changes in grating frequency
-    to changes in the most effective noise frequency."""
-
-    #compute slopes for observers
+                                grating_freq, vp),
+                            lightness_matches_figure,
+                            [('vp', vp), ('grating_contrast', contrast),
+                                ('grating_freq', grating_freq)],
+                            connected=plot_lines,
+                            highlight_unseen=highlight_unseen))
+    figures.build(jobs, data, processes)
+
+def observer_dip_ratios(data):
+    """Fit the dip of every observer and grating frequency and return the
+    ratios of dip frequencies between the low and the middle, and the middle
+    and the high grating frequency, together with the sorted grating
+    frequencies."""
     all_dips = np.full((3, 8), np.nan)
     grating_freqs = [grating_frequencies[gf] for gf in
                         np.unique(data.grating_freq)]
     grating_freqs.sort()
+    strengths = illusion.illusion_strengths(data, ('vp', 'grating_freq'))
     for i, vp_data in enumerate(data.by_field('vp')):
         for j, freq_data in enumerate(vp_data.by_field('grating_freq')):
             if freq_data.vp[0] == 'n4' and freq_data.grating_freq[0]==.2:
                 continue
-            fit = fit_gaussian(freq_data, constrained=True)
+            fit = fit_gaussian(freq_data, constrained=True,
+                    strength=strengths[(freq_data.vp[0],
+                        freq_data.grating_freq[0])])
             try:
                 all_dips[j, i] = fit.best_values['center']
             except KeyError:
                 pass
     all_dips = np.ma.MaskedArray(all_dips, np.isnan(all_dips))
-    slope_low = (all_dips[1] / all_dips[0]).mean() / (grating_freqs[1] /
-            grating_freqs[0])
-    slope_high = (all_dips[2] / all_dips[1]).mean() / (grating_freqs[2] /
-            grating_freqs[1])
-    # bootstrap slopes
-    slope_dist_low = np.full(10000, np.nan)
-    slope_dist_high = np.full(10000, np.nan)
-    for i in xrange(10000):
-        ratio_low = (all_dips[1] / all_dips[0]).compressed()
-        ratio_high = (all_dips[2] / all_dips[1]).compressed()
-        slope_dist_low[i] = np.random.choice(ratio_low, len(ratio_low)).mean()
-        slope_dist_high[i] = np.random.choice(ratio_high, len(ratio_high)).mean()
-    slope_dist_low /= (grating_freqs[1] / grating_freqs[0])
-    slope_dist_high /= (grating_freqs[2] / grating_freqs[1])
+    ratio_low = (all_dips[1] / all_dips[0]).compressed()
+    ratio_high = (all_dips[2] / all_dips[1]).compressed()
+    return ratio_low, ratio_high, grating_freqs
 
+def compute_slope(data, n_boot=10000):
+    """Compute the slope of the function relating changes in grating frequency
+    to changes in the most effective noise frequency."""
 
+    #compute slopes for observers
+    ratio_low, ratio_high, grating_freqs = observer_dip_ratios(data)
+    slope_low = ratio_low.mean() / (grating_freqs[1] / grating_freqs[0])
+    slope_high = ratio_high.mean() / (grating_freqs[2] / grating_freqs[1])
+    # bootstrap slopes
+    slope_dist_low = bootstrap.bootstrap(ratio_low, n_boot=n_boot) / (
+            grating_freqs[1] / grating_freqs[0])
+    slope_dist_high = bootstrap.bootstrap(ratio_high, n_boot=n_boot) / (
+            grating_freqs[2] / grating_freqs[1])
 
     # compute slope for models
     model_dips = np.full((2, 2), np.nan)
@@ -399,8 +450,10 @@ def compute_slope(data):
     flodog = evaluate_models.get_model_data('flodog')
     for i, model_data in enumerate([biwam, flodog]):
         model_data = model_data[model_data.grating_freq!=.2]
+        strengths = illusion.illusion_strengths(model_data, ('grating_freq',))
         for j, freq_data in enumerate(model_data.by_field('grating_freq')):
-            fit = evaluate_models.fit_gaussian(freq_data, constrained=True)
+            fit = evaluate_models.fit_gaussian(freq_data, constrained=True,
+                    strength=strengths[(freq_data.grating_freq[0],)])
             try:
                 model_dips[j, i] = fit.best_values['center']
             except KeyError:
@@ -413,6 +466,24 @@ def compute_slope(data):
     return (slope_low, slope_high, slope_dist_low, slope_dist_high,
             slope_biwam, slope_flodog)
 
+def slope_intervals(data, n_boot=10000, alpha=.05, method='bca'):
+    """Bootstrap confidence intervals with coverage 1 - alpha of the observer
+    slopes between the low and the middle, and the middle and the high
+    grating frequency. method is 'bca' or 'percentile'."""
+    ratio_low, ratio_high, grating_freqs = observer_dip_ratios(data)
+    intervals = []
+    for ratios, freq_ratio in [
+            (ratio_low, grating_freqs[1] / grating_freqs[0]),
+            (ratio_high, grating_freqs[2] / grating_freqs[1])]:
+        distribution = bootstrap.bootstrap(ratios, n_boot=n_boot)
+        if method == 'bca':
+            interval = bootstrap.bca_interval(ratios, distribution,
+                    alpha=alpha)
+        else:
+            interval = bootstrap.percentile_interval(distribution, alpha)
+        intervals.append(interval / freq_ratio)
+    return intervals
+
 def grating_freq_vs_dip_freq(data):
     """Plot the most effective noise frequency against grating frequency"""
     #colors = ['#deebf7', '#c6dbef', '#9ecae1', '#6baed6', '#4292c6', '#2171b5',
@@ -422,13 +493,16 @@ def grating_freq_vs_dip_freq(data):
     data = data[data.noise_type=='global']
     fig, ax = plt.subplots(figsize=(3,3))
     all_dips = np.full((3, 8), np.nan)
+    strengths = illusion.illusion_strengths(data, ('vp', 'grating_freq'))
     for i, vp_data in enumerate(data.by_field('vp')):
         grating_freqs = [grating_frequencies[gf] for gf in
                             np.unique(vp_data.grating_freq)]
         grating_freqs.sort()
         dip_frequencies = np.full(len(np.unique(vp_data.grating_freq)), np.nan)
         for j, freq_data in enumerate(vp_data.by_field('grating_freq')):
-            fit = fit_gaussian(freq_data, constrained=True)
+            fit = fit_gaussian(freq_data, constrained=True,
+                    strength=strengths[(freq_data.vp[0],
+                        freq_data.grating_freq[0])])
             try:
                 dip_frequencies[j] = fit.best_values['center']
                 all_dips[j, i] = fit.best_values['center']
@@ -449,8 +523,10 @@ def grating_freq_vs_dip_freq(data):
                             np.unique(model_data.grating_freq)]
         grating_freqs.sort()
         dip_frequencies = np.full(len(np.unique(model_data.grating_freq)), np.nan)
+        strengths = illusion.illusion_strengths(model_data, ('grating_freq',))
         for j, freq_data in enumerate(model_data.by_field('grating_freq')):
-            fit = evaluate_models.fit_gaussian(freq_data, constrained=True)
+            fit = evaluate_models.fit_gaussian(freq_data, constrained=True,
+                    strength=strengths[(freq_data.grating_freq[0],)])
             try:
                 dip_frequencies[j] = fit.best_values['center']
             except KeyError:
@@ -491,8 +567,7 @@ if __name__ == '__main__':
     data = get_all_data(clean=False)
 
 
-    for i, vp_data in enumerate(data.by_field('vp')):
-        global_noise_illusion_strength(vp_data)
+    global_noise_illusion_strengths(data)
 
     # filter out non-standard observers
     data = data[np.in1d(data.vp, ['e1', 'n7', 'n2'], invert=True)]
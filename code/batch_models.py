@@ -0,0 +1,349 @@
+from __future__ import division
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+# NumPy port of the FLODOG model as implemented by Robinson et al. (2007) in
+# f_l_odog_models. In contrast to the MATLAB code, the filters are
+# transformed once and every convolution is a broadcast product over a whole
+# stack of images, so that the noise sweeps can be evaluated in batches.
+# BiwamBatchModel ports the BIWaM model in CIWaM the same way: the wavelet
+# transform filters all images of a stack at once with separable filters.
+
+# Filter ffts are cached on disk in cache_dir (set to None to disable), and
+# the cache_size most recently used filter banks are also kept in memory.
+cache_dir = '../filter_cache'
+cache_size = 4
+_filter_cache = OrderedDict()
+
+def cached_filters(name, params, build):
+    """Return the filter bank identified by name and the parameters in the
+    dict params. If the bank is neither in memory nor on disk, it is created
+    by calling build() and stored."""
+    key = repr((name, sorted(params.items())))
+    if key in _filter_cache:
+        filters = _filter_cache.pop(key)
+    else:
+        fn = None
+        if cache_dir is not None:
+            fn = os.path.join(cache_dir, '%s_%s.npy' % (name,
+                hashlib.md5(key.encode('utf-8')).hexdigest()))
+        if fn is not None and os.path.exists(fn):
+            filters = np.load(fn, mmap_mode='r')
+        else:
+            filters = build()
+            if fn is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                # write to a temporary file first, so that concurrent
+                # processes never read a partially written bank
+                tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+                with open(tmp_fn, 'wb') as f:
+                    np.save(f, filters)
+                os.rename(tmp_fn, fn)
+        while len(_filter_cache) >= cache_size:
+            _filter_cache.popitem(last=False)
+    _filter_cache[key] = filters
+    return filters
+
+def d2gauss(n1, std1, n2, std2, theta):
+    """2D Gaussian of size n2 x n1, rotated counter clockwise by theta,
+    normalized to unit sum (see f_l_odog_models/d2gauss.m)"""
+    x = np.arange(-(n1 - 1) / 2, n1 / 2)
+    y = np.arange(-(n2 - 1) / 2, n2 / 2)
+    xs, ys = np.meshgrid(x, y)
+    coor_x = np.cos(theta) * xs - np.sin(theta) * ys
+    coor_y = np.sin(theta) * xs + np.cos(theta) * ys
+    h = (np.exp(-coor_x ** 2 / (2 * std1 ** 2)) *
+         np.exp(-coor_y ** 2 / (2 * std2 ** 2)))
+    return h / h.sum()
+
+def dog(n1, std1, n2, std2, spread_ratio, theta):
+    """oriented difference of Gaussians of size n2 x n1, with the surround
+    spread along the second axis (see f_l_odog_models/dog.m)"""
+    return (d2gauss(n1, std1, n2, std2, theta) -
+            d2gauss(n1, std1, n2, std2 * spread_ratio, theta))
+
+class FlodogBatchModel(object):
+    """FLODOG model of Robinson et al. (2007), with the filters of
+    f_l_odog_models/BM_model_params.m and local normalization by orientation
+    and frequency (see flodog_normalize.m). evaluate_batch() takes a stack of
+    images of shape (N, height, width)."""
+
+    def __init__(self, img_size=(512, 512), pixels_per_degree=31,
+                    orientations=np.arange(0, 180, 30), n_scales=7,
+                    sigx=4, sr=1, sdmix=.5, batch_size=5):
+        self.img_size = tuple(img_size)
+        self.orientations = np.asarray(orientations)
+        self.batch_size = batch_size
+        space_const = 2. ** np.arange(n_scales) * 1.5
+        self.stdev_pixels = space_const / np.sqrt(2)
+        cpd = 1 / (2 * space_const / pixels_per_degree * 2 *
+                    np.sqrt(np.log(2)))
+        self.w_val = cpd ** .1
+        # the image is padded by the filter size before the fft, as in
+        # ourconv.m
+        self.fft_shape = (2 * self.img_size[0], 2 * self.img_size[1])
+        # the filters do not depend on the pixels per degree, only the
+        # weights do
+        self.filter_params = {'img_size': self.img_size,
+                              'orientations': [float(angle) for angle in
+                                  self.orientations],
+                              'n_scales': n_scales}
+        self.filter_ffts = cached_filters('flodog_filters', self.filter_params,
+            lambda: self.transform_filters(
+                [[dog(self.img_size[1], std, self.img_size[0], std, 2,
+                      angle * np.pi / 180) for std in self.stdev_pixels]
+                    for angle in self.orientations]))
+        # weights for pooling the normalizer across spatial frequencies
+        scales = np.arange(n_scales)
+        mix = np.exp(-(scales[:, np.newaxis] - scales) ** 2 /
+                (2 * sdmix ** 2))
+        self.mix_weights = mix / mix.sum(1)[:, np.newaxis]
+        mask_params = dict(self.filter_params, sigx=sigx, sr=sr)
+        self.mask_ffts = cached_filters('flodog_masks', mask_params,
+            lambda: self.transform_filters(
+                [[d2gauss(self.img_size[1], sigx * std, self.img_size[0],
+                          sigx * std * sr, angle * np.pi / 180)
+                    for std in self.stdev_pixels]
+                    for angle in self.orientations]))
+
+    def transform_filters(self, filters):
+        """compute the zero padded ffts of a nested list of filters"""
+        filters = np.asarray(filters)
+        return np.fft.rfft2(filters, s=self.fft_shape)
+
+    def convolve(self, image_fft, filter_fft):
+        """convolve a stack of padded image ffts with one or more filters,
+        and crop the result to the image size (see ourconv.m)"""
+        rows, cols = self.img_size
+        result = np.fft.irfft2(image_fft * filter_fft, s=self.fft_shape)
+        return result[..., rows // 2: rows // 2 + rows,
+                           cols // 2: cols // 2 + cols]
+
+    def pad_fft(self, images, pad):
+        padded = np.empty((images.shape[0],) + self.fft_shape)
+        padded[...] = pad
+        padded[:, :self.img_size[0], :self.img_size[1]] = images
+        return np.fft.rfft2(padded)
+
+    def normalize(self, responses, orientation):
+        """combine the filter responses of one orientation, given as an array
+        of shape (N, n_scales, height, width)"""
+        responses = responses * self.w_val[:, np.newaxis, np.newaxis]
+        normalizer = np.tensordot(responses, self.mix_weights,
+                axes=([1], [1])).transpose(0, 3, 1, 2)
+        # local mean of the squared normalizer, computed for all scales and
+        # images at once
+        normalizer_fft = self.pad_fft(
+                normalizer.reshape((-1,) + self.img_size) ** 2, 0)
+        normalizer_fft = normalizer_fft.reshape(normalizer.shape[:2] +
+                normalizer_fft.shape[1:])
+        local_normalizer = self.convolve(normalizer_fft,
+                self.mask_ffts[orientation])
+        local_normalizer = np.sqrt(local_normalizer + 1e-6)
+        return (responses / (local_normalizer + 1e-6)).sum(1)
+
+    def evaluate_batch(self, images):
+        """evaluate the model on a stack of images. Images are processed in
+        chunks of self.batch_size to limit memory usage."""
+        images = np.asarray(images, dtype='float64')
+        output = np.empty(images.shape)
+        for start in range(0, images.shape[0], self.batch_size):
+            chunk = images[start:start + self.batch_size]
+            image_fft = self.pad_fft(chunk, .5)[:, np.newaxis]
+            result = 0
+            for o in range(len(self.orientations)):
+                responses = self.convolve(image_fft, self.filter_ffts[o])
+                result = result + self.normalize(responses, o)
+            output[start:start + self.batch_size] = result
+        return output
+
+    def evaluate(self, image):
+        return self.evaluate_batch(np.asarray(image)[np.newaxis])[0]
+
+# 1D filter of the wavelet transform of CIWaM, normalized to unit sum
+wavelet_filter = np.array([1., 4., 6., 4., 1.]) / 16
+
+# parameters of the contrast sensitivity function of CIWaM (see
+# CIWaM/generate_csf.m): offset, contrast_max, contrast_min, sigma1 and
+# sigma2 of the maximum and the minimum of the CSF
+csf_params = {'intensity': ((0., 1., 0., 1.25, 1.25), (2., 1., 1., 2., 1.)),
+              'colour': ((1., 2., 0., 2., 1.25), (2., 1., 1., 2., 2.))}
+
+def shifted(padded, axis, start, length):
+    index = [slice(None)] * padded.ndim
+    index[axis] = slice(start, start + length)
+    return padded[tuple(index)]
+
+def symmetric_filtering(images, axis):
+    """Filter a stack of images with wavelet_filter along axis (-1:
+    horizontally, -2: vertically). The edges are mirrored without repeating
+    the edge pixels (see CIWaM/symmetric_filtering.m)."""
+    pad = len(wavelet_filter) // 2
+    pad_width = [(0, 0)] * images.ndim
+    pad_width[axis] = (pad, pad)
+    padded = np.pad(images, pad_width, mode='reflect')
+    result = np.zeros(images.shape)
+    for k, weight in enumerate(wavelet_filter):
+        result += weight * shifted(padded, axis, k, images.shape[axis])
+    return result
+
+def decimate(images, axis):
+    """Keep every second pixel along axis, starting with the first, and set
+    the others to zero"""
+    result = np.zeros(images.shape)
+    index = [slice(None)] * images.ndim
+    index[axis] = slice(None, None, 2)
+    result[tuple(index)] = images[tuple(index)]
+    return result
+
+def expand(residual):
+    """Upsample a residual plane by inserting zeros and interpolate it with
+    the wavelet filter"""
+    upsampled = np.zeros(residual.shape[:-2] + (2 * residual.shape[-2],
+        2 * residual.shape[-1]))
+    upsampled[..., ::2, ::2] = residual
+    return 4 * symmetric_filtering(symmetric_filtering(upsampled, -2), -1)
+
+def dwt_level(images):
+    """One level of the wavelet transform of CIWaM/DWT.m. Returns the
+    horizontal, vertical and diagonal wavelet planes, and the residual at
+    half the resolution."""
+    horizontal_blur = symmetric_filtering(images, -1)
+    horizontal_detail = images - 2 * symmetric_filtering(
+            decimate(horizontal_blur, -1), -1)
+    blur = symmetric_filtering(horizontal_blur, -2)
+    vertical = horizontal_blur - 2 * symmetric_filtering(
+            decimate(blur, -2), -2)
+    horizontal = 2 * symmetric_filtering(decimate(symmetric_filtering(
+        horizontal_detail, -2), -2), -2)
+    residual = blur[..., ::2, ::2]
+    diagonal = images - (expand(residual) + horizontal + vertical)
+    return (horizontal, vertical, diagonal), residual
+
+def add_padding(images):
+    """Pad a stack of images to a square with a power of 2 side length, by
+    mirroring at the right and bottom edges (see CIWaM/add_padding.m)"""
+    height, width = images.shape[-2:]
+    size = 2 ** int(np.ceil(np.log2(max(height, width))))
+    return np.pad(images, [(0, 0)] * (images.ndim - 2) +
+            [(0, size - height), (0, size - width)], mode='reflect')
+
+def correlate_symmetric(images, kernel):
+    """Correlate a stack of images with a 2D kernel, mirroring the edges
+    including the edge pixels, like imfilter(images, kernel, 'symmetric')"""
+    height, width = images.shape[-2:]
+    center_y, center_x = (kernel.shape[0] - 1) // 2, (kernel.shape[1] - 1) // 2
+    padded = np.pad(images, [(0, 0)] * (images.ndim - 2) +
+            [(center_y, kernel.shape[0] - 1 - center_y),
+             (center_x, kernel.shape[1] - 1 - center_x)], mode='symmetric')
+    result = np.zeros(images.shape)
+    for y, x in zip(*np.nonzero(kernel)):
+        result += kernel[y, x] * padded[..., y:y + height, x:x + width]
+    return result
+
+def contrast_kernels(center_size, surround_size):
+    """Center and surround windows of the relative contrast of the
+    horizontal, vertical and diagonal wavelet planes (see
+    relative_contrast in CIWaM/CIWaM.m)"""
+    center = np.ones((1, center_size))
+    surround = np.concatenate([np.ones(surround_size), np.zeros(center_size),
+        np.ones(surround_size)])[np.newaxis]
+    diagonal_center = np.ceil((np.eye(center_size) +
+        np.fliplr(np.eye(center_size))) / 4)
+    diagonal_surround = np.diag(surround[0])
+    diagonal_surround = diagonal_surround + np.fliplr(diagonal_surround)
+    return [(center, surround), (center.T, surround.T),
+            (diagonal_center, diagonal_surround)]
+
+def csf(s, contrast_max, contrast_min, sigma1, sigma2):
+    """Contrast sensitivity function of Otazu et al. (2008) at the distance
+    s of a scale from the peak"""
+    if s > 0:
+        return ((contrast_max - contrast_min) * np.exp(-s ** 2 /
+            (2 * sigma2 ** 2)) + contrast_min)
+    return contrast_max * np.exp(-s ** 2 / (2 * sigma1 ** 2))
+
+class BiwamBatchModel(object):
+    """BIWaM model of Otazu et al. (2008), ported from the intensity channel
+    of CIWaM/CIWaM.m with the parameters of evaluate_matlab_models.m.
+    evaluate_batch() takes a stack of images of shape (N, height, width).
+    The number of wavelet levels is derived from the image size like in
+    evaluate_matlab_models.m, unless n_levels is given."""
+
+    def __init__(self, window_sizes=(5, 4), nu_0=2.967, n_levels=None,
+                    mode='intensity', batch_size=5):
+        self.window_sizes = tuple(window_sizes)
+        self.nu_0 = nu_0
+        self.n_levels = n_levels
+        self.mode = mode
+        self.batch_size = batch_size
+        self.kernels = contrast_kernels(*window_sizes)
+
+    def csf_weights(self, scale):
+        """Weights of the relative contrast and offset of the induction
+        factor at a scale (counted from 1), see CIWaM/generate_csf.m"""
+        s = scale - self.nu_0
+        params_max, params_min = csf_params[self.mode]
+        return (csf(s - params_max[0], *params_max[1:]),
+                csf(s - params_min[0], *params_min[1:]))
+
+    def relative_contrast(self, plane, orientation):
+        """Relative contrast of every coefficient of the wavelet planes of one
+        orientation (0: horizontal, 1: vertical, 2: diagonal)"""
+        center, surround = self.kernels[orientation]
+        squared = plane ** 2
+        sigma_center = (correlate_symmetric(squared, center ** 2) /
+                (center == 1).sum())
+        sigma_surround = (correlate_symmetric(squared, surround ** 2) /
+                (surround == 1).sum())
+        r = sigma_center / (sigma_surround + 1e-6)
+        return r ** 2 / (1 + r ** 2)
+
+    def induction(self, images):
+        """Brightness induction for a stack of images"""
+        height, width = images.shape[-2:]
+        n_levels = self.n_levels
+        if n_levels is None:
+            n_levels = int(np.floor(np.log((max(height, width) - 1) / 4) /
+                np.log(2))) + 1
+        residual = add_padding(images)
+        # the weighted wavelet planes of all orientations, summed per level
+        weighted = []
+        for level in range(n_levels):
+            planes, residual = dwt_level(residual)
+            weight_max, weight_min = self.csf_weights(level + 1)
+            weighted.append(sum(plane * (self.relative_contrast(plane,
+                orientation) * weight_max + weight_min) for orientation,
+                plane in enumerate(planes)))
+        # inverse wavelet transform, see CIWaM/IDWT.m
+        result = residual
+        for planes in reversed(weighted):
+            result = expand(result) + planes
+        return result[..., :height, :width]
+
+    def evaluate_batch(self, images):
+        """evaluate the model on a stack of images. Images are processed in
+        chunks of self.batch_size to limit memory usage."""
+        images = np.asarray(images, dtype='float64')
+        output = np.empty(images.shape)
+        for start in range(0, images.shape[0], self.batch_size):
+            output[start:start + self.batch_size] = self.induction(
+                    images[start:start + self.batch_size])
+        return output
+
+    def evaluate(self, image):
+        return self.evaluate_batch(np.asarray(image)[np.newaxis])[0]
+
+def patch_means(model, stimuli, idx_inc, idx_dec):
+    """evaluate model on a stack of stimuli and return the mean model output
+    in the incremental and decremental test patches for every stimulus.
+    Models without batch support are evaluated image by image."""
+    stimuli = np.asarray(stimuli)
+    if hasattr(model, 'evaluate_batch'):
+        output = model.evaluate_batch(stimuli)
+    else:
+        output = np.array([model.evaluate(stimulus) for stimulus in stimuli])
+    return output[:, idx_inc].mean(1), output[:, idx_dec].mean(1)
@@ -0,0 +1,51 @@
+from __future__ import division
+import numpy as np
+
+import lazy
+
+stats = lazy.LazyModule('scipy.stats')
+
+# Vectorized nonparametric bootstrap. All resamples of a chunk are drawn as
+# one (n_resamples, n) index matrix and the statistic is computed with a
+# single reduction along axis 1, so statistic must accept an axis argument
+# (e.g. np.mean, np.median).
+
+def bootstrap(data, statistic=np.mean, n_boot=10000, chunk_size=100000,
+                rng=np.random):
+    """Return the bootstrap distribution of statistic over n_boot resamples
+    of the 1D array data. Resamples are drawn in chunks of chunk_size to
+    bound memory usage."""
+    data = np.asarray(data)
+    n = len(data)
+    distribution = np.empty(n_boot)
+    for start in range(0, n_boot, chunk_size):
+        size = min(chunk_size, n_boot - start)
+        samples = data[rng.randint(0, n, (size, n))]
+        distribution[start:start + size] = statistic(samples, axis=1)
+    return distribution
+
+def percentile_interval(distribution, alpha=.05):
+    """Percentile confidence interval with coverage 1 - alpha"""
+    return np.percentile(distribution, [50 * alpha, 100 - 50 * alpha])
+
+def bca_interval(data, distribution, statistic=np.mean, alpha=.05):
+    """Bias corrected and accelerated confidence interval (Efron, 1987) with
+    coverage 1 - alpha, for a bootstrap distribution of statistic on data.
+    The acceleration is estimated with the jackknife."""
+    data = np.asarray(data)
+    n = len(data)
+    estimate = statistic(data)
+    # bias correction, counting ties as half
+    bias = stats.norm.ppf(((distribution < estimate).sum() +
+                           .5 * (distribution == estimate).sum()) /
+                          len(distribution))
+    # all leave-one-out samples as rows of an (n, n - 1) matrix
+    jackknife_idx = np.arange(1, n) + np.arange(n)[:, np.newaxis]
+    jackknife = statistic(data[jackknife_idx % n], axis=1)
+    deviation = jackknife.mean() - jackknife
+    denominator = 6 * (deviation ** 2).sum() ** 1.5
+    acceleration = (deviation ** 3).sum() / denominator if denominator else 0
+    z = stats.norm.ppf([alpha / 2, 1 - alpha / 2])
+    levels = stats.norm.cdf(bias + (bias + z) /
+            (1 - acceleration * (bias + z)))
+    return np.percentile(distribution, 100 * levels)
@@ -0,0 +1,48 @@
+from __future__ import division
+import numpy as np
+
+# Composition of the test stimuli of experiment.py and evaluate_models.py:
+# a grating centered on a mid gray background, overlaid with noise,
+#   clip(.5 * (background + noise * mask + .5), 0, 1)
+# The stimulus is written into a caller provided buffer, one frame per noise
+# mask, with in-place ufuncs only, so composing a stack of stimuli does not
+# allocate any full frame temporaries.
+
+def grating_in_noise(grating, noise=None, out=None, flip=False, mask=None,
+        dtype='float64'):
+    """Compose grating in noise into out and return it. noise is a noise
+    mask, a sequence of noise masks for a stack of stimuli, or None for a
+    stimulus without noise (of the size of the grating, unless out is
+    given). flip rotates the noise masks by 180deg, either all of them or
+    those where a sequence of flags is true. mask is an optional window
+    that the noise is multiplied with. If out is None, a new array of dtype
+    is returned, of shape (size, size) for a single noise mask and
+    (n, size, size) for a sequence."""
+    single = noise is None or (isinstance(noise, np.ndarray) and
+            noise.ndim == 2)
+    noises = [noise] if single else noise
+    if out is None:
+        frame_shape = grating.shape if noise is None else noises[0].shape
+        if not single:
+            frame_shape = (len(noises),) + frame_shape
+        out = np.empty(frame_shape, dtype=dtype)
+    frames = out[np.newaxis] if single else out
+    flips = np.broadcast_to(flip, (len(noises),))
+    for frame, frame_noise, frame_flip in zip(frames, noises, flips):
+        if frame_noise is None:
+            frame.fill(0)
+            continue
+        if frame_flip:
+            frame_noise = frame_noise[::-1, ::-1]
+        if mask is None:
+            np.multiply(frame_noise, .5, out=frame)
+        else:
+            np.multiply(frame_noise, mask, out=frame)
+            frame *= .5
+    # .5 * (noise + .5) plus .5 * background, which is .5 outside the grating
+    frames += .5
+    y_border = (frames.shape[1] - grating.shape[0]) // 2
+    x_border = (frames.shape[2] - grating.shape[1]) // 2
+    frames[:, y_border:y_border + grating.shape[0],
+            x_border:x_border + grating.shape[1]] += .5 * grating - .25
+    return np.clip(out, 0, 1, out=out)
@@ -0,0 +1,95 @@
+from __future__ import division
+import sys
+import multiprocessing
+import numpy as np
+
+import analyze_noise_data
+import illusion
+import bootstrap
+
+# Bootstrap confidence intervals for the inverted Gaussian fits of
+# analyze_noise_data.fit_gaussian. The reps of every noise frequency are
+# resampled with replacement and the inverted Gaussian is refitted to every
+# resample on a process pool. Each refit starts from the best values of the
+# fit to the full data.
+
+fit_params = ('center', 'width', 'minimum')
+
+def resample_reps(illusion_strength, n_boot, rng=np.random):
+    """Resample the reps within each noise frequency. Returns an array of
+    shape (n_boot, n_freqs, n_reps)."""
+    n_freqs, n_reps = illusion_strength.shape
+    idx = rng.randint(0, n_reps, (n_boot, n_freqs, n_reps))
+    return illusion_strength[np.arange(n_freqs)[:, np.newaxis], idx]
+
+def refit(args):
+    """Fit all resamples of a chunk at once and return an array with one row
+    of fit_params per resample."""
+    noise_frequencies, resamples, constrained, init = args
+    fits = analyze_noise_data.fit_illusion_strengths(noise_frequencies,
+            resamples, constrained, init)
+    return np.array([[fit.best_values[param] for param in fit_params]
+        for fit in fits])
+
+def dip_distribution(strength, fit, constrained=False, n_boot=2000,
+        processes=None, chunk_size=500, seed=0):
+    """Return the bootstrap distribution of center, width and minimum as an
+    array of shape (n_boot, 3). strength is (noise_frequencies,
+    illusion_strength) and fit the fit to the full data. The refits are
+    distributed over a process pool (one process per core by default)."""
+    noise_frequencies, illusion_strength = strength
+    resamples = resample_reps(illusion_strength, n_boot,
+            np.random.RandomState(seed))
+    tasks = [(noise_frequencies, resamples[start:start + chunk_size],
+              constrained, fit.best_values)
+             for start in range(0, n_boot, chunk_size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        values = pool.map(refit, tasks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return np.concatenate(values)
+
+def dip_intervals(data, constrained=False, strength=None, n_boot=2000,
+        alpha=.05, processes=None, seed=0):
+    """Fit an inverted Gaussian to the illusion strength in data and return a
+    dict that maps center, width and minimum to their percentile confidence
+    intervals with coverage 1 - alpha. Returns None if the best fit is a
+    horizontal line, i.e. the data have no dip."""
+    if strength is None:
+        strength = illusion.illusion_strengths(data, ())[()]
+    fit = analyze_noise_data.fit_gaussian(data, constrained, strength)
+    if 'center' not in fit.best_values:
+        return None
+    distribution = dip_distribution(strength, fit, constrained, n_boot,
+            processes, seed=seed)
+    distribution = distribution[~np.isnan(distribution).any(1)]
+    # the log of the width enters the fit squared, so width and 1 / width
+    # give the same curve. Use the side of the full data fit.
+    log_width = np.abs(np.log(distribution[:, fit_params.index('width')]))
+    if fit.best_values['width'] < 1:
+        log_width = -log_width
+    distribution[:, fit_params.index('width')] = np.exp(log_width)
+    return dict((param, bootstrap.percentile_interval(distribution[:, i],
+        alpha)) for i, param in enumerate(fit_params))
+
+def observer_intervals(data, constrained=True, n_boot=2000, processes=None):
+    """Confidence intervals of the dip fits of all observers, grating
+    frequencies and noise types in data, keyed like
+    illusion.illusion_strengths."""
+    strengths = illusion.illusion_strengths(data)
+    intervals = {}
+    for vp_data in data.by_field('vp'):
+        for freq_data in vp_data.by_field('grating_freq'):
+            for type_data in freq_data.by_field('noise_type'):
+                key = (type_data.vp[0], type_data.grating_freq[0],
+                        type_data.noise_type[0])
+                intervals[key] = dip_intervals(type_data, constrained,
+                        strengths[key], n_boot, processes=processes)
+                sys.stdout.write('\r%s %s %s' % key)
+                sys.stdout.flush()
+    return intervals
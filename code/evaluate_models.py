@@ -1,17 +1,24 @@
 from __future__ import division
+import os
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
 import sys
-import lmfit
 
-import odog_model as om
-import dakin_bex_model as dbm
-import biwam
-import flodog
+import lazy
+import batch_models
+import noise_bank
+import narrowband_noise
+import result_store
+import illusion
+import fit_cache
+import gaussian_fit
+import stimulus_templates
+import compose
 
-from ocupy import datamat
-from scipy.io import loadmat
+# plotting and the lightness models are only imported when they are used
+matplotlib = lazy.LazyModule('matplotlib')
+plt = lazy.LazyModule('matplotlib.pyplot')
+om = lazy.LazyModule('odog_model')
+dbm = lazy.LazyModule('dakin_bex_model')
 
 global grating_frequencies
 grating_frequencies = {.1: .103,#.098,
@@ -23,122 +30,207 @@ grating_frequencies = {.1: .103,#.098,
 
 def prepare_grating(bar_width, n_bars, idx_check):
     # create square wave grating
-    grating = np.ones((bar_width * n_bars, bar_width * n_bars)) * .45
-    index = [i + j for i in range(bar_width) for j in
-                range(0, bar_width * n_bars, bar_width * 2)]
-    grating[index, :] = .55
+    grating = stimulus_templates.square_wave(bar_width, n_bars, (.55, .45))
     # place test squares at appropriate position
     stimulus = np.ones((512, 512)) * .5
-    tmp = grating.shape[0] / 2
+    tmp = grating.shape[0] // 2
     stimulus[256-tmp: 256+tmp, 256-tmp: 256+tmp] = grating
     stimulus[idx_check] = .5
     return stimulus
 
-def add_noise(grating, noise_freq, rep, version):
-    noise_dir = '../noise'
-    noise = loadmat(noise_dir + '/noise512_31ppd_%1.2f_%d.mat' % (noise_freq,
-                rep + 1))['noise'].astype('float64')
+# noise masks are synthesized from a seed, and the results are written to
+# ../data/seed<noise_seed>. To use the noise masks of the publication
+# instead, and write to ../data, set noise_bank_fn to a noise bank created
+# with python noise_bank.py ../noise ../noise/noise512_bank.npy
+noise_bank_fn = None
+noise_seed = 0
+# synthesized masks are stored in a noise bank per seed, which all models,
+# grating frequencies and worker processes share through its memory map
+synthesized_noise_dir = '../noise_cache'
+
+def synthesized_bank_fn():
+    return os.path.join(synthesized_noise_dir,
+            'noise512_seed%d_bank.npy' % noise_seed)
+
+def prepare_noise():
+    """Synthesize the noise bank of noise_seed, unless it exists or a noise
+    bank of the publication is used. Call this before starting worker
+    processes, so that they do not synthesize the masks themselves."""
+    if noise_bank_fn is not None or os.path.exists(synthesized_bank_fn()):
+        return
+    if not os.path.isdir(synthesized_noise_dir):
+        os.makedirs(synthesized_noise_dir)
+    narrowband_noise.synthesize_bank(synthesized_bank_fn(), noise_frequencies,
+            25, seed=noise_seed)
+
+def get_noise(noise_freq, rep):
+    """Return the noise mask for a noise frequency and repetition, as a
+    read-only float32 view of a noise bank"""
+    if noise_bank_fn is None:
+        prepare_noise()
+        return noise_bank.open_bank(synthesized_bank_fn()).get(31,
+                noise_freq, rep)
+    return noise_bank.open_bank(noise_bank_fn).get(31, noise_freq, rep)
+
+def noise_source():
+    """Name of the noise masks in use, either a noise bank or the seed of the
+    synthesized masks"""
+    if noise_bank_fn is None:
+        return 'seed%d' % noise_seed
+    return 'bank_%s' % os.path.splitext(os.path.basename(noise_bank_fn))[0]
+
+def result_fn(model_name):
+    """Result file of the model simulations of a model. ../data holds the
+    published results, so results with synthesized noise masks are stored
+    in a subdirectory named after the noise source, and results of the ports
+    of the MATLAB models in the subdirectory batch_models."""
+    result_dir = '../data'
+    if noise_bank_fn is None:
+        result_dir = os.path.join(result_dir, noise_source())
+    if model_name in matlab_models:
+        result_dir = os.path.join(result_dir, 'batch_models')
+    return os.path.join(result_dir, '%s.csv' % model_name)
+
+def open_result_file(model_name, suffix=''):
+    """Open the result file of a model (plus suffix) for writing, creating
+    its directory if needed"""
+    fn = result_fn(model_name) + suffix
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    return open(fn, 'w')
+
+def add_noise(grating, noise_freq, rep, version, noise=None, out=None):
+    if noise is None:
+        noise = get_noise(noise_freq, rep)
     # rotate noise mask 180deg on second half of repetitions
-    if version == 1:
-        noise = noise[::-1, ::-1]
-    noise_masked = noise + .5
-    stim_in_noise = .5 * (grating+noise_masked)
-    return np.fmin(np.fmax(0, stim_in_noise), 1)
+    return compose.grating_in_noise(grating, noise, out, flip=version == 1)
+
+def noisy_stimuli(grating, noise_freq, conditions, out=None,
+        dtype='float64'):
+    """Generate the stack of stimuli for a list of (repeat, version)
+    conditions, composed in out (by default a new array of dtype). The
+    noise mask of a repeat is only created once for consecutive conditions
+    with the same repeat."""
+    noises = []
+    repeat_noise = None, None
+    for repeat, version in conditions:
+        if repeat_noise[0] != repeat:
+            repeat_noise = repeat, get_noise(noise_freq, repeat)
+        noises.append(repeat_noise[1])
+    return compose.grating_in_noise(grating, noises, out,
+            flip=[version == 1 for _, version in conditions], dtype=dtype)
+
+noise_frequencies = np.round(2 ** np.arange(-np.log2(9), np.log2(9)+.01,
+    np.log2(9) / 4), decimals=2)
+models = ['odog', 'dbm', 'biwam', 'flodog']
+# the BIWaM and FLODOG results in ../data were computed with the original
+# MATLAB code (evaluate_matlab_models.m). Their NumPy ports in batch_models
+# are only evaluated when named explicitly, and write to a subdirectory.
+matlab_models = ['biwam', 'flodog']
+default_models = [model for model in models if model not in matlab_models]
+grating_freqs = ['.2', '.4', '.8']
+
+def get_model(model_nr):
+    if model_nr == 0:
+        model = om.OdogModel(img_size=(512, 512), pixels_per_degree=31)
+    elif model_nr == 1:
+        model = dbm.DBmodel(img_size=(512, 512), bandwidth=2)
+    elif model_nr == 2:
+        model = batch_models.BiwamBatchModel()
+    elif model_nr == 3:
+        model = batch_models.FlodogBatchModel(img_size=(512, 512),
+                pixels_per_degree=31)
+    return model
+
+def prepare_test_grating(grating_freq):
+    """Return the grating stimulus for a grating frequency, and the locations
+    of the incremental and decremental test patches. The arrays are built
+    once per grating frequency and are read-only."""
+    return stimulus_templates.template(('test_grating', grating_freq),
+            lambda: _build_test_grating(grating_freq))
+
+def _build_test_grating(grating_freq):
+    if grating_freq == '.8':
+        bar_width = 20
+        n_bars = 12
+    elif grating_freq == '.4':
+        bar_width = 40
+        n_bars = 6
+    elif grating_freq == '.2':
+        bar_width = 80
+        n_bars = 4
+
+    # determine location of incremental and decremental patches
+    idx_upper = np.zeros((512, 512), dtype=bool)
+    idx_lower = np.zeros((512, 512), dtype=bool)
+    idx_upper[256-bar_width:256, 226-bar_width:226] = True
+    idx_lower[256:256+bar_width, 286:286+bar_width] = True
+    if n_bars % 4 == 0:
+        idx_inc = idx_upper
+        idx_dec = idx_lower
+    else:
+        idx_dec = idx_upper
+        idx_inc = idx_lower
+    grating = prepare_grating(bar_width, n_bars, (idx_inc | idx_dec))
+    return grating, idx_inc, idx_dec
+
+def result_lines(trial_nr, grating_freq, value_inc, value_dec,
+                    noise_freq=None, repeat=0, version=0):
+    """Format the result lines for the incremental and decremental test patch
+    of one stimulus. noise_freq=None denotes the stimulus without noise."""
+    if noise_freq is None:
+        return ['%d none -1.0 0.5 %f %s 0.1 0.0 0\n' % (trial_nr,
+                    value_inc, grating_freq),
+                '%d none 1.0 0.5 %f %s 0.1 0.0 0\n' % (trial_nr + 1,
+                    value_dec, grating_freq)]
+    return [('%d global -1.0 0.5 %f %s 0.1 %1.2f %d\n') % (trial_nr,
+                value_inc, grating_freq, noise_freq, repeat + 25 * version),
+            ('%d global 1.0 0.5 %f %s 0.1 %1.2f %d\n') % (trial_nr + 1,
+                value_dec, grating_freq, noise_freq,
+                repeat - 25 * (version - 1))]
+
+result_header = ('Trial noise_type coaxial_lum test_lum match_lum' +
+                    ' grating_freq grating_contrast noise_freq rep\n')
 
 # compute results for isotropic noise
-def analyze_frequencies():
-    noise_frequencies = np.round(2 ** np.arange(-np.log2(9), np.log2(9)+.01,
-        np.log2(9) / 4), decimals=2)
-    models = ['odog', 'dbm', 'biwam', 'flodog']
-    grating_freqs = ['.2', '.4', '.8']
-    for model_nr in range(2):
-        if model_nr == 0:
-            model = om.OdogModel(img_size=(512, 512), pixels_per_degree=31)
-        elif model_nr == 1:
-            model = dbm.DBmodel(img_size=(512, 512), bandwidth=2)
-        elif model_nr == 2:
-            model = biwam.Biwam()
-        elif model_nr == 3:
-            model = flodog.Flodog()
-        with open('../data/%s.csv' % models[model_nr], 'w') as result:
-            result.write('Trial noise_type coaxial_lum test_lum match_lum' +
-                            ' grating_freq grating_contrast noise_freq rep\n')
+def analyze_frequencies(model_nrs=[models.index(model) for model in
+        default_models]):
+    for model_nr in model_nrs:
+        model = get_model(model_nr)
+        with open_result_file(models[model_nr]) as result:
+            result.write(result_header)
             trial_nr = 0
+            # the stimuli of all noise frequencies share one buffer
+            stimuli = None
             for grating_freq in grating_freqs:
-                if grating_freq == '.8':
-                    bar_width = 20
-                    n_bars = 12
-                elif grating_freq == '.4':
-                    bar_width = 40
-                    n_bars = 6
-                elif grating_freq == '.2':
-                    bar_width = 80
-                    n_bars = 4
                 sys.stdout.write('\rgrating frequency: %s' % grating_freq)
                 sys.stdout.flush()
-
-                # determine location of incremental and decremental patches
-                idx_upper = np.zeros((512, 512), dtype=bool)
-                idx_lower = np.zeros((512, 512), dtype=bool)
-                idx_upper[256-bar_width:256, 226-bar_width:226] = True
-                idx_lower[256:256+bar_width, 286:286+bar_width] = True
-                if n_bars % 4 == 0:
-                    idx_inc = idx_upper
-                    idx_dec = idx_lower
-                else:
-                    idx_dec = idx_upper
-                    idx_inc = idx_lower
-                grating = prepare_grating(bar_width, n_bars, (idx_inc |
-                    idx_dec))
+                grating, idx_inc, idx_dec = prepare_test_grating(grating_freq)
 
                 for noise_freq in noise_frequencies:
-                    for repeat in range(25):
-                        for version in [0, 1]:
-                            stimulus = add_noise(grating, noise_freq, repeat,
-                                    version)
-                            output = model.evaluate(stimulus)
-                            value_inc = output[idx_inc].mean()
-                            value_dec = output[idx_dec].mean()
-                            result_line = (('%d global -1.0 0.5 %f %s 0.1 ' +
-                                    '%1.2f %d\n') % (trial_nr, value_inc,
-                                        grating_freq, noise_freq,
-                                        repeat + 25 * version))
-                            result.write(result_line)
-                            trial_nr += 1
-                            result_line = (('%d global 1.0 0.5 %f %s 0.1 ' +
-                                    '%1.2f %d\n') % (trial_nr, value_dec,
-                                        grating_freq, noise_freq,
-                                        repeat - 25 * (version - 1)))
-                            result.write(result_line)
-                            trial_nr += 1
+                    # evaluate all repetitions of a noise frequency as one
+                    # stack of stimuli
+                    conditions = [(repeat, version) for repeat in range(25)
+                                    for version in [0, 1]]
+                    stimuli = noisy_stimuli(grating, noise_freq, conditions,
+                            stimuli)
+                    values_inc, values_dec = batch_models.patch_means(model,
+                            stimuli, idx_inc, idx_dec)
+                    for (repeat, version), value_inc, value_dec in zip(
+                            conditions, values_inc, values_dec):
+                        result.writelines(result_lines(trial_nr, grating_freq,
+                            value_inc, value_dec, noise_freq, repeat, version))
+                        trial_nr += 2
                 # compute result without noise
                 output = model.evaluate((grating + .5) * .5)
-                value_inc = output[idx_inc].mean()
-                value_dec = output[idx_dec].mean()
-                result_line = ('%d none -1.0 0.5 %f %s 0.1 0.0 0\n' % (trial_nr,
-                    value_inc, grating_freq))
-                result.write(result_line)
-                trial_nr += 1
-                result_line = ('%d none 1.0 0.5 %f %s 0.1 0.0 0\n' % (trial_nr,
-                    value_dec, grating_freq))
-                result.write(result_line)
-                trial_nr += 1
+                result.writelines(result_lines(trial_nr, grating_freq,
+                    output[idx_inc].mean(), output[idx_dec].mean()))
+                trial_nr += 2
 
 def compute_illusion_strength(data):
     """Compute illusion strength for all noise frequencies. Data should be
     appropriately filtered (one type of noise, one subject)"""
-    noise_frequencies = np.unique(data.noise_freq)
-    n_freqs = len(noise_frequencies)
-    n_reps = len(np.unique(data.rep))
-    illusion_strength = np.empty((n_freqs, n_reps))
-    for i, data_by_nf in enumerate(data.by_field('noise_freq')):
-        increments = [d.match_lum for d in
-            data_by_nf[data_by_nf.coaxial_lum == -1].by_field('rep')]
-        decrements = [d.match_lum for d in
-            data_by_nf[data_by_nf.coaxial_lum == 1].by_field('rep')]
-        illusion_strength[i, :] = np.asarray(increments).flatten() - \
-                                  np.asarray(decrements).flatten()
-    return illusion_strength
+    return illusion.compute_illusion_strength(data)
 
 def inverted_gaussian(x, center, baseline, width, minimum):
     x = np.log(x)
@@ -147,35 +239,45 @@ def inverted_gaussian(x, center, baseline, width, minimum):
     return baseline - (baseline + minimum) * np.exp(
             -(x - center) ** 2 / ((width / np.sqrt(2 * np.log(2))) ** 2))
 
-def fit_gaussian(data, constrained=False):
-    illusion_strength = compute_illusion_strength(data)
-    noise_frequencies = np.unique(data.noise_freq)
-    n_reps = illusion_strength.shape[1]
+def fit_gaussian(data, constrained=False, strength=None):
+    """Fit an inverted Gaussian to the illusion strength in data. strength can
+    be given as (noise_frequencies, illusion_strength) if it is already
+    computed. Fits are cached, see fit_cache.py."""
+    if strength is None:
+        strength = illusion.illusion_strengths(data, ())[()]
+    noise_frequencies, illusion_strength = strength
     # fit a horizontal line if the data do not have any real dip
-    if data.vp[0] in ['dbm', 'odog'] or (data.vp[0] == 'biwam' and
-            data.grating_freq[0] == .2):
-        model = lmfit.Model(lambda x, baseline: baseline)
-        params = lmfit.Parameters()
-        params.add('baseline', value=5)
-    else:
-        params = lmfit.Parameters()
-        #params.add('center', value=3)
-        params.add('center',
-                value=noise_frequencies[np.argmin(illusion_strength.mean(1))],
-                max=9, min=.01)
-        params.add('width', value=3)
-        if constrained:
-            minimum = illusion_strength.mean(1).min()
-            params.add('baseline', value=5, max=8.8)
-            params.add('minimum', value=-minimum, min=-6, max=-minimum+1)
-        else:
-            params.add('baseline', value=5)
-            params.add('minimum', value=5)
-        model = lmfit.Model(inverted_gaussian)
-    result = model.fit(illusion_strength.ravel(),
-                       x=noise_frequencies.repeat(n_reps),
-                       params=params)
-    return result
+    fit_line = bool(data.vp[0] in ['dbm', 'odog'] or
+            (data.vp[0] == 'biwam' and data.grating_freq[0] == .2))
+    return fit_cache.cached_fit('evaluate_models.fit_gaussian', strength,
+            {'constrained': constrained, 'fit_line': fit_line},
+            inverted_gaussian,
+            lambda: fit_illusion_strength(noise_frequencies,
+                illusion_strength, constrained, fit_line),
+            gaussian_fit.fitter)
+
+def fit_illusion_strength(noise_frequencies, illusion_strength, constrained,
+                            fit_line):
+    """Fit an inverted Gaussian, or a horizontal line if fit_line is True, to
+    the illusion strength with gaussian_fit. Returns a fit_cache.FitResult."""
+    n_reps = illusion_strength.shape[1]
+    if fit_line:
+        return fit_cache.FitResult(inverted_gaussian,
+                {'baseline': float(illusion_strength.mean())})
+    start = [noise_frequencies[np.argmin(illusion_strength.mean(1))], 3, 5, 5]
+    lower = [.01, -np.inf, -np.inf, -np.inf]
+    upper = [9, np.inf, np.inf, np.inf]
+    if constrained:
+        minimum = illusion_strength.mean(1).min()
+        start[3] = -minimum
+        upper[2] = 8.8
+        lower[3] = -6
+        upper[3] = -minimum + 1
+    best_params = gaussian_fit.fit(noise_frequencies.repeat(n_reps),
+            illusion_strength.reshape((1, -1)), [start], lower, upper,
+            minimum_sign=1, width_scale=1 / np.sqrt(2 * np.log(2)))
+    return fit_cache.FitResult(inverted_gaussian,
+            gaussian_fit.best_values(best_params)[0])
 
 def plot_illusion_strength(data, baseline_data, ax, plot_xticks=True):
     """Plot strength of White's illusion per noise frequency"""
@@ -194,9 +296,9 @@ def plot_illusion_strength(data, baseline_data, ax, plot_xticks=True):
     baseline_dec = baseline_data[baseline_data.coaxial_lum == 1].match_lum
     baseline_strength = baseline_inc.mean() - baseline_dec.mean()
 
-    illusion_strength = compute_illusion_strength(data)
-    noise_frequencies = np.unique(data.noise_freq)
-    fit = fit_gaussian(data, constrained=True)
+    strength = illusion.illusion_strengths(data, ())[()]
+    noise_frequencies, illusion_strength = strength
+    fit = fit_gaussian(data, constrained=True, strength=strength)
     x_vals = np.linspace(.1, 10, 1000)
     #spline_fit = interpolate.UnivariateSpline(
     #        noise_frequencies, illusion_strength.mean(1), s=19)
@@ -278,9 +380,9 @@ def global_noise_illusion_strength(data):
     plt.close(fig)
 
 def get_model_data(model_name):
-    data = datamat.CsvFactory('../data/%s.csv' % model_name)
-    data.add_field('vp', [model_name] * len(data))
-    data.add_parameter('exp_type', 'fast_matching')
+    records = result_store.load(['../data/%s.csv' % model_name],
+            'model_%s' % model_name, labels={'vp': [model_name]})
+    data = result_store.to_datamat(records, {'exp_type': 'fast_matching'})
 
     if model_name == 'biwam':
         data.match_lum *= 88
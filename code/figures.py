@@ -0,0 +1,152 @@
+from __future__ import division
+import os
+import sys
+import json
+import hashlib
+import inspect
+import multiprocessing
+import numpy as np
+
+# Incremental, parallel rendering of figures. A plot job is a tuple
+# (fig_fn, func, selection, kwargs): func(data, fig_fn=fig_fn, **kwargs)
+# renders the subset of the data that matches selection, a tuple of
+# (field, value) pairs, and saves it as fig_fn. Jobs are rendered with the
+# Agg backend on a process pool. A figure is only rendered again if the hash
+# of its data, options and code differs from the one of the last build, which
+# is stored in manifest_fn. The code is the source of func and of all
+# functions of its module that it calls, directly or through other functions.
+
+manifest_fn = '../figures/figure_hashes.json'
+
+# data of the current build, set in every worker process by init_worker
+_data = None
+
+def plot_job(fig_fn, func, selection=(), **kwargs):
+    return (fig_fn, func, tuple(selection), kwargs)
+
+def select(data, selection):
+    """Return the part of data where every field of selection has its
+    value"""
+    idx = np.ones(len(data), dtype=bool)
+    for field, value in selection:
+        idx &= getattr(data, field) == value
+    return data[idx]
+
+def func_source(func):
+    """Source code of a plotting function, or its byte code if the source is
+    not available"""
+    try:
+        source = inspect.getsource(func)
+    except (IOError, TypeError):
+        return func.__code__.co_code
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return source
+
+def code_names(code):
+    """Global names used by a code object and the functions defined in it"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+def plot_functions(func):
+    """The plotting function and the functions of its module that it calls,
+    like the helpers that draw into the axes of a figure"""
+    functions = [func]
+    for function in functions:
+        for name in sorted(code_names(function.__code__)):
+            called = function.__globals__.get(name)
+            if (inspect.isfunction(called) and called.__module__ ==
+                    func.__module__ and called not in functions):
+                functions.append(called)
+    return functions
+
+def data_hash(job, data):
+    """Hash of the plotting code, the options and the data of a job"""
+    fig_fn, func, selection, kwargs = job
+    key = hashlib.sha1(('%s.%s' % (func.__module__, func.__name__)).encode(
+        'utf-8'))
+    for function in plot_functions(func):
+        key.update(func_source(function))
+    key.update(repr(sorted(kwargs.items())).encode('utf-8'))
+    for field in sorted(data.fieldnames()):
+        values = getattr(data, field)
+        key.update(field.encode('utf-8'))
+        if values.dtype == object:
+            key.update(repr(values.tolist()).encode('utf-8'))
+        else:
+            key.update(np.ascontiguousarray(values).tobytes())
+        key.update(np.ascontiguousarray(np.ma.getmaskarray(values)).tobytes())
+    return key.hexdigest()
+
+def load_manifest():
+    if not os.path.exists(manifest_fn):
+        return {}
+    with open(manifest_fn) as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    tmp_fn = manifest_fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.rename(tmp_fn, manifest_fn)
+
+def init_worker(data):
+    global _data
+    import matplotlib
+    matplotlib.use('Agg')
+    _data = data
+
+def render_job(job, data):
+    fig_fn, func, selection, kwargs = job
+    func(select(data, selection), fig_fn=fig_fn, **kwargs)
+    return fig_fn
+
+def render(job):
+    return render_job(job, _data)
+
+def build(jobs, data, processes=None, force=False):
+    """Render all plot jobs on data whose figure is missing or out of date,
+    on a process pool (one process per core by default, processes=1 renders
+    in this process, with the current matplotlib backend). With force all
+    figures are rendered."""
+    manifest = load_manifest()
+    hashes = {}
+    pending = []
+    for job in jobs:
+        fig_fn = job[0]
+        hashes[fig_fn] = data_hash(job, select(data, job[2]))
+        if (force or manifest.get(fig_fn) != hashes[fig_fn] or not
+                os.path.exists(fig_fn)):
+            pending.append(job)
+        if not os.path.isdir(os.path.dirname(fig_fn)):
+            os.makedirs(os.path.dirname(fig_fn))
+    if not pending:
+        return
+    pool = None
+    try:
+        if processes == 1:
+            rendered = (render_job(job, data) for job in pending)
+        else:
+            # the data is passed to the workers explicitly, so that they do
+            # not depend on inheriting it from a forked parent
+            pool = multiprocessing.Pool(processes, init_worker, (data,))
+            rendered = pool.imap_unordered(render, pending)
+        for i, fig_fn in enumerate(rendered):
+            manifest[fig_fn] = hashes[fig_fn]
+            sys.stdout.write('\rrendered %d of %d figures' % (i + 1,
+                len(pending)))
+            sys.stdout.flush()
+        sys.stdout.write('\n')
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        save_manifest(manifest)
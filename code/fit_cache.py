@@ -0,0 +1,66 @@
+from __future__ import division
+import os
+import json
+import hashlib
+import numpy as np
+
+# Cache for the curve fits of the analysis scripts. A fit is identified by a
+# name, a hash of the content of the fitted arrays, the fit options and the
+# name and version of the fitter, so that a changed fitter never returns the
+# fits of an earlier one. Fit
+# results are kept in memory and stored as small json files in cache_dir (set
+# to None to disable), so every fit is only optimized once.
+
+cache_dir = '../fit_cache'
+_fits = {}
+
+class FitResult(object):
+    """Best fitting parameter values of a fit, with the best_values and eval()
+    interface of lmfit.model.ModelResult. Fits without a 'center' are
+    horizontal lines, which evaluate to their baseline."""
+
+    def __init__(self, func, best_values):
+        self.func = func
+        self.best_values = best_values
+
+    def eval(self, x):
+        if 'center' not in self.best_values:
+            return self.best_values['baseline']
+        return self.func(x, **self.best_values)
+
+def fit_key(name, arrays, options, fitter):
+    key = hashlib.sha1(name.encode('utf-8'))
+    key.update(fitter.encode('utf-8'))
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype='float64')
+        key.update(repr(array.shape).encode('utf-8'))
+        key.update(array.tobytes())
+    key.update(repr(sorted(options.items())).encode('utf-8'))
+    return key.hexdigest()
+
+def cached_fit(name, arrays, options, func, fit, fitter):
+    """Return the fit identified by name, the arrays that are fitted, the
+    dict of fit options and the fitter, a string with the name and version
+    of the fitting code. If it is not cached, fit() is called, which must
+    return an object with best_values, like an lmfit ModelResult. func is
+    the fitted function, used by FitResult.eval()."""
+    key = fit_key(name, arrays, options, fitter)
+    if key not in _fits:
+        fn = None
+        if cache_dir is not None:
+            fn = os.path.join(cache_dir, key + '.json')
+        if fn is not None and os.path.exists(fn):
+            with open(fn) as f:
+                best_values = json.load(f)
+        else:
+            best_values = dict((param, float(value)) for param, value in
+                    fit().best_values.items())
+            if fn is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+                with open(tmp_fn, 'w') as f:
+                    json.dump(best_values, f)
+                os.rename(tmp_fn, fn)
+        _fits[key] = FitResult(func, best_values)
+    return _fits[key]
@@ -0,0 +1,107 @@
+from __future__ import division
+import numpy as np
+
+# Least squares fitter for the inverted Gaussians in log frequency space of
+# analyze_noise_data.py and evaluate_models.py, which fits many data sets at
+# once. Both are instances of
+#   baseline - (baseline + minimum_sign * minimum) *
+#       exp(-(log(x) - log(center)) ** 2 / (width_scale * log(width)) ** 2)
+# The parameters (in the order of params) of all data sets are optimized
+# together by a bounded Levenberg-Marquardt iteration with the analytic
+# Jacobian.
+
+params = ('center', 'width', 'baseline', 'minimum')
+
+# name and version of the fitter for fit_cache, increase the version whenever
+# a change of the fitter can change its results
+fitter = 'gaussian_fit-1'
+
+# log(width) has to be defined
+min_width = 1e-12
+
+def evaluate(x, p, minimum_sign=-1, width_scale=1.):
+    """Evaluate the curves with parameters p (shape (n_sets, 4)) at x.
+    Returns an array of shape (n_sets, len(x))."""
+    center, width, baseline, minimum = [p[:, i, np.newaxis] for i in
+            range(4)]
+    amplitude = baseline + minimum_sign * minimum
+    with np.errstate(divide='ignore'):
+        dist = np.log(x) - np.log(center)
+    return baseline - amplitude * np.exp(-dist ** 2 /
+            (width_scale * np.log(width)) ** 2)
+
+def jacobian(x, p, minimum_sign=-1, width_scale=1.):
+    """Derivatives of the curves with respect to the parameters, shape
+    (n_sets, len(x), 4)"""
+    center, width, baseline, minimum = [p[:, i, np.newaxis] for i in
+            range(4)]
+    amplitude = baseline + minimum_sign * minimum
+    with np.errstate(divide='ignore'):
+        dist = np.log(x) - np.log(center)
+    scaled_width = width_scale * np.log(width)
+    gauss = np.exp(-dist ** 2 / scaled_width ** 2)
+    # x = 0 (no noise) lies infinitely far from the center, where the
+    # Gaussian vanishes together with its derivatives
+    with np.errstate(invalid='ignore'):
+        gauss_dist = np.where(gauss > 0, gauss * dist, 0)
+        gauss_dist2 = np.where(gauss > 0, gauss_dist * dist, 0)
+    jac = np.empty(p.shape[:1] + np.shape(x) + (4,))
+    jac[..., 0] = -2 * amplitude * gauss_dist / (center * scaled_width ** 2)
+    jac[..., 1] = (-2 * amplitude * gauss_dist2 /
+            (width * np.log(width) * scaled_width ** 2))
+    jac[..., 2] = 1 - gauss
+    jac[..., 3] = -minimum_sign * gauss
+    return jac
+
+def fit(x, y, init, lower, upper, minimum_sign=-1, width_scale=1.,
+        max_iter=200, tol=1e-10):
+    """Fit the curves to the data sets y (shape (n_sets, len(x))). init,
+    lower and upper are the starting values and bounds of the parameters,
+    arrays of shape (n_sets, 4). Returns the best parameters, shape
+    (n_sets, 4)."""
+    y = np.asarray(y, dtype=float)
+    lower = np.broadcast_to(lower, y.shape[:1] + (4,)).copy()
+    lower[:, 1] = np.maximum(lower[:, 1], min_width)
+    upper = np.broadcast_to(upper, lower.shape)
+    p = np.clip(np.array(init, dtype=float), lower, upper)
+    damping = np.full(len(y), 1e-3)
+    cost = ((evaluate(x, p, minimum_sign, width_scale) - y) ** 2).sum(1)
+    active = np.ones(len(y), dtype=bool)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if not len(idx):
+            break
+        residuals = evaluate(x, p[idx], minimum_sign, width_scale) - y[idx]
+        jac = jacobian(x, p[idx], minimum_sign, width_scale)
+        gradient = np.einsum('ijk,ij->ik', jac, residuals)
+        hessian = np.einsum('ijk,ijl->ikl', jac, jac)
+        diagonal = np.einsum('ikk->ik', hessian)
+        # parameters at a bound with the gradient pointing outwards are kept
+        # fixed for this step
+        fixed = (((p[idx] <= lower[idx]) & (gradient > 0)) |
+                 ((p[idx] >= upper[idx]) & (gradient < 0)))
+        gradient[fixed] = 0
+        hessian[fixed[:, :, np.newaxis] | fixed[:, np.newaxis, :]] = 0
+        system = hessian + (damping[idx, np.newaxis] *
+                np.maximum(diagonal, 1e-12) + fixed)[:, :, np.newaxis] * \
+                np.eye(4)
+        step = -np.linalg.solve(system, gradient[:, :, np.newaxis])[:, :, 0]
+        candidate = np.clip(p[idx] + step, lower[idx], upper[idx])
+        new_cost = ((evaluate(x, candidate, minimum_sign, width_scale) -
+                     y[idx]) ** 2).sum(1)
+        better = new_cost < cost[idx]
+        improvement = np.where(better, cost[idx] - new_cost, 0)
+        p[idx[better]] = candidate[better]
+        damping[idx] = np.where(better, damping[idx] / 10,
+                damping[idx] * 10)
+        # converged when an accepted step hardly decreases the cost, or when
+        # no step is accepted even with strong damping
+        done = ((better & (improvement <= tol * (1 + cost[idx]))) |
+                (damping[idx] > 1e10))
+        cost[idx[better]] = new_cost[better]
+        active[idx[done]] = False
+    return p
+
+def best_values(p, names=params):
+    """Convert fitted parameters to a list of best_values dicts"""
+    return [dict(zip(names, map(float, row))) for row in p]
@@ -0,0 +1,56 @@
+from __future__ import division
+import numpy as np
+
+def illusion_strengths(data, group_fields=('vp', 'grating_freq',
+                                            'noise_type')):
+    """Compute the illusion strength (increment minus decrement match) for all
+    groups of trials in data that share the values of group_fields, with a
+    single sort of all trials. Within a group and noise frequency, increment
+    and decrement trials are paired in order of rep.
+    data can be a datamat or a structured array. Returns a dict that maps
+    tuples of group values to (noise_frequencies, illusion_strength), where
+    illusion_strength has shape (n_freqs, n_reps)."""
+    groups = [np.asarray(getattr(data, field)) for field in group_fields]
+    noise_freq = np.asarray(data.noise_freq)
+    coaxial_lum = np.asarray(data.coaxial_lum)
+    match_lum = np.asarray(data.match_lum)
+    # np.lexsort uses the last key as primary key
+    order = np.lexsort([np.asarray(data.rep), coaxial_lum, noise_freq] +
+            groups[::-1])
+    increments = order[coaxial_lum[order] == -1]
+    decrements = order[coaxial_lum[order] == 1]
+    assert len(increments) == len(decrements)
+    assert (noise_freq[increments] == noise_freq[decrements]).all()
+    strength = match_lum[increments] - match_lum[decrements]
+    freqs = noise_freq[increments]
+    keys = [group[increments] for group in groups]
+
+    group_start = np.zeros(len(increments), dtype=bool)
+    group_start[:1] = True
+    for key in keys:
+        group_start[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(group_start)
+    ends = np.append(starts[1:], len(increments))
+    result = {}
+    for start, end in zip(starts, ends):
+        noise_frequencies, first, counts = np.unique(freqs[start:end],
+                return_index=True, return_counts=True)
+        if (counts == counts[0]).all():
+            group_strength = strength[start:end].reshape(
+                    (len(noise_frequencies), -1))
+        else:
+            # a noise frequency with a single pair of trials, like the
+            # condition without noise in the model data, is repeated for all
+            # reps
+            group_strength = np.empty((len(noise_frequencies), counts.max()))
+            for i, (offset, count) in enumerate(zip(first, counts)):
+                group_strength[i] = strength[start + offset:
+                                             start + offset + count]
+        result[tuple(key[start] for key in keys)] = (noise_frequencies,
+                group_strength)
+    return result
+
+def compute_illusion_strength(data):
+    """Compute illusion strength for all noise frequencies. Data should be
+    appropriately filtered (one type of noise, one subject)"""
+    return illusion_strengths(data, ())[()][1]
@@ -0,0 +1,36 @@
+import importlib
+
+# Deferred imports for the heavy dependencies of the analysis scripts
+# (matplotlib, scipy, the lightness models), so that loading data and
+# computing summaries does not pay for plotting or model code. A LazyModule
+# stands in for a module and imports it on first attribute access, e.g.
+#   plt = lazy.LazyModule('matplotlib.pyplot')
+
+class LazyModule(object):
+    """Module that is imported when one of its attributes is first used.
+    Submodules that the module itself does not import, like
+    matplotlib.gridspec, are imported on access as well. An ImportError is
+    only raised if the module itself cannot be imported, a missing attribute
+    raises AttributeError like a module does."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attr)
+        except AttributeError:
+            pass
+        try:
+            return importlib.import_module(self._name + '.' + attr)
+        except ImportError:
+            raise AttributeError('module %r has no attribute %r' % (
+                self._name, attr))
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
@@ -0,0 +1,136 @@
+from __future__ import division
+import os
+import sys
+import numpy as np
+
+import noise_bank
+
+# NumPy version of stimuli/narrowband_noise.m and generate_noisemasks.m:
+# bandpass filtered white noise with a bandwidth of one octave. The noise is
+# synthesized from a half-plane spectrum with random phases, so that many
+# candidate masks are created with a single batched inverse rfft2. Candidates
+# whose extreme values exceed the limits are rejected, as in the MATLAB code.
+
+_filters = {}
+
+def freq_filter(n, low, high):
+    """Amplitude spectrum of a Gaussian bandpass filter with half power at
+    low and high (in cycles per image), in unshifted rfft layout. See
+    FreqFilt.m with options 'G', 'P', 'E', '+'."""
+    key = (n, low, high)
+    if key not in _filters:
+        fy = np.fft.fftfreq(n, 1 / n)[:, np.newaxis]
+        fx = np.fft.rfftfreq(n, 1 / n)[np.newaxis, :]
+        frequency = np.sqrt(fy ** 2 + fx ** 2)
+        center = (low + high) / 2
+        # the space constant refers to the 1/e and not to the 1/2 value point
+        space_const = (center - low) / np.sqrt(np.log(2))
+        # sqrt, because the filter is defined on power, not amplitude
+        _filters[key] = np.sqrt(np.exp(-((center - frequency) /
+            space_const) ** 2))
+    return _filters[key]
+
+def random_spectrum(n, n_masks, rng):
+    """Random unit amplitude spectra in rfft layout, drawn as in GenSpec2.m:
+    the real part is uniform in [-1, 1] and the imaginary part has random
+    sign. The first and the Nyquist column are made hermitian, components
+    without conjugate are -1, and the DC component is zero."""
+    real = rng.uniform(-1, 1, (n_masks, n, n // 2 + 1))
+    imag = np.sqrt(1 - real ** 2) * np.sign(rng.uniform(-1, 1, real.shape))
+    spectrum = real + 1j * imag
+    for col in [0, n // 2]:
+        spectrum[:, n // 2 + 1:, col] = np.conj(
+                spectrum[:, n // 2 - 1:0:-1, col])
+        spectrum[:, [0, n // 2], col] = -1
+    spectrum[:, 0, 0] = 0
+    return spectrum
+
+def narrowband_noise(freq, n_masks=1, mask_size=512, ppd=31.277,
+                        noise_rms=.2, max_noise=.4, min_noise=-.4,
+                        batch_size=16, rng=np.random):
+    """Create n_masks noise masks of shape (mask_size, mask_size) with center
+    frequency freq (in cycles per degree). The RMS contrast is given relative
+    to a mean luminance of .5, i.e. the RMS of the masks is noise_rms / 2.
+    Only masks with all values between min_noise and max_noise are kept."""
+    # low cut off frequency in cycles per image width
+    frequency = 2 / 3 * freq / ppd * mask_size
+    nn = 2 ** int(np.ceil(np.log2(mask_size)))
+    f = freq_filter(nn, frequency, frequency * 2)
+    # the power of the full spectrum is twice the power of the half plane
+    total_power = 2 * (f ** 2).sum() - (f[:, 0] ** 2).sum() - \
+            (f[:, -1] ** 2).sum()
+    const = noise_rms * nn ** 2 / np.sqrt(total_power)
+
+    masks = np.empty((n_masks, mask_size, mask_size))
+    n_found = 0
+    while n_found < n_masks:
+        candidates = np.fft.irfft2(random_spectrum(nn, batch_size, rng) *
+                f * const, s=(nn, nn))[:, :mask_size, :mask_size]
+        # divide by two to achieve the RMS contrast used by Salmela and
+        # Laurinen, which is normalized by mean luminance .5
+        candidates /= 2
+        valid = ((candidates.max(axis=(1, 2)) <= max_noise) &
+                 (candidates.min(axis=(1, 2)) >= min_noise))
+        candidates = candidates[valid][:n_masks - n_found]
+        masks[n_found:n_found + len(candidates)] = candidates
+        n_found += len(candidates)
+    return masks
+
+def noise_limits(noise_freq):
+    """Limits on the noise values for a given frequency, as used in
+    generate_noisemasks.m"""
+    if noise_freq > 2:
+        return -.43, .43
+    return -.4, .4
+
+def noise_mask(noise_freq, rep, mask_size=512, ppd=31.2770941620795, seed=0,
+                batch_size=4):
+    """Synthesize the noise mask for a noise frequency and repetition, with
+    the limits of generate_noisemasks.m. The random generator is seeded from
+    (seed, noise_freq, rep), so the same mask can be recreated at any time."""
+    rng = np.random.RandomState([seed, int(round(noise_freq * 100)), rep])
+    min_noise, max_noise = noise_limits(noise_freq)
+    return narrowband_noise(noise_freq, 1, mask_size, ppd, .2, max_noise,
+            min_noise, batch_size, rng)[0]
+
+def synthesize_bank(bank_fn, noise_freqs, n_reps, mask_size=512,
+        ppd=31.2770941620795, seed=0):
+    """Store the masks of noise_mask() for all noise frequencies and
+    repetitions in a noise bank file. The bank is written under a temporary
+    name and renamed when complete, so an existing bank file is always
+    complete."""
+    tmp_fn = os.path.splitext(bank_fn)[0] + '_tmp.npy'
+    ppds = [int(round(ppd))]
+    bank = noise_bank.create_bank(tmp_fn, ppds, noise_freqs, n_reps,
+            mask_size)
+    for j, noise_freq in enumerate(noise_freqs):
+        for rep in range(n_reps):
+            bank[0, j, rep] = noise_mask(noise_freq, rep, mask_size, ppd, seed)
+    bank.flush()
+    del bank
+    noise_bank.save_index(tmp_fn, ppds, noise_freqs,
+            np.ones((len(ppds), len(noise_freqs), n_reps), dtype=bool))
+    # the index first, so the bank file never exists without its index
+    os.rename(noise_bank.index_fn(tmp_fn), noise_bank.index_fn(bank_fn))
+    os.rename(tmp_fn, bank_fn)
+
+def generate_noisemasks(bank_fn, n_masks=25, mask_size=512,
+                            ppd=31.2770941620795, rng=np.random):
+    """Generate noise masks at all noise frequencies and store them in a noise
+    bank file. Only the first 5 masks are needed for the experiment."""
+    noise_freqs = np.round(2 ** np.arange(-np.log2(9), np.log2(9) + .01,
+        np.log2(9) / 4) * 100) / 100
+    ppds = [int(round(ppd))]
+    bank = noise_bank.create_bank(bank_fn, ppds, noise_freqs, n_masks,
+            mask_size)
+    for j, noise_freq in enumerate(noise_freqs):
+        min_noise, max_noise = noise_limits(noise_freq)
+        bank[0, j] = narrowband_noise(noise_freq, n_masks, mask_size, ppd, .2,
+                max_noise, min_noise, rng=rng)
+    bank.flush()
+    noise_bank.save_index(bank_fn, ppds, noise_freqs,
+            np.ones(bank.shape[:3], dtype=bool))
+
+if __name__ == '__main__':
+    # usage: python narrowband_noise.py bank_fn [n_masks]
+    generate_noisemasks(sys.argv[1], *[int(arg) for arg in sys.argv[2:]])
@@ -0,0 +1,96 @@
+from __future__ import division
+import os
+import re
+import sys
+import numpy as np
+
+# All noise masks of one mask size are stored in a single contiguous float32
+# array of shape (n_ppd, n_freqs, n_reps, size, size), saved in .npy format and
+# opened as a read-only memory map. The pixels per degree and noise
+# frequencies along the first two axes are stored in an index file next to it.
+# Use convert() to build a bank from the noise mask files created by
+# generate_noisemasks.m (.mat) or used by experiment.py (.npy), or create the
+# masks directly with narrowband_noise.generate_noisemasks().
+
+mask_pattern = re.compile(r'noise(\d+)_(\d+)ppd_(\d*\.\d+)_(\d+)\.(mat|npy)$')
+
+def index_fn(bank_fn):
+    return os.path.splitext(bank_fn)[0] + '_index.npz'
+
+class NoiseBank(object):
+    """Read-only access to the noise masks in a bank file. Masks are returned
+    as views into the memory map, without copying."""
+
+    def __init__(self, bank_fn):
+        self.masks = np.load(bank_fn, mmap_mode='r')
+        index = np.load(index_fn(bank_fn))
+        self.ppds = [int(ppd) for ppd in index['ppds']]
+        self.noise_freqs = ['%1.2f' % freq for freq in index['noise_freqs']]
+        self.available = index['available']
+
+    def get(self, ppd, noise_freq, rep):
+        """Return the noise mask for the given pixels per degree and noise
+        frequency. rep counts from 0, i.e. it refers to the mask file with
+        number rep + 1."""
+        i = self.ppds.index(int(round(ppd)))
+        j = self.noise_freqs.index('%1.2f' % noise_freq)
+        if not self.available[i, j, rep]:
+            raise KeyError('no noise mask for %dppd, %1.2fcpd, rep %d' %
+                    (ppd, noise_freq, rep))
+        return self.masks[i, j, rep]
+
+_banks = {}
+
+def open_bank(bank_fn):
+    """Open a bank file, reusing the memory map if it is already open"""
+    if bank_fn not in _banks:
+        _banks[bank_fn] = NoiseBank(bank_fn)
+    return _banks[bank_fn]
+
+def read_mask(fn):
+    if fn.endswith('.mat'):
+        from scipy.io import loadmat
+        return loadmat(fn)['noise']
+    return np.load(fn)
+
+def create_bank(bank_fn, ppds, noise_freqs, n_reps, size):
+    """Create a new bank file and return it as a writable memory map. The
+    index has to be written with save_index() once the masks are filled in."""
+    return np.lib.format.open_memmap(bank_fn, mode='w+', dtype='float32',
+            shape=(len(ppds), len(noise_freqs), n_reps, size, size))
+
+def save_index(bank_fn, ppds, noise_freqs, available):
+    np.savez(index_fn(bank_fn), ppds=ppds,
+            noise_freqs=[float(freq) for freq in noise_freqs],
+            available=available)
+
+def convert(noise_dir, bank_fn):
+    """Collect all noise mask files in noise_dir into a new bank file. All
+    masks must have the same size."""
+    masks = {}
+    sizes = set()
+    for fn in os.listdir(noise_dir):
+        match = mask_pattern.match(fn)
+        if match is None:
+            continue
+        size, ppd, freq, rep, _ = match.groups()
+        masks[(int(ppd), '%1.2f' % float(freq), int(rep) - 1)] = fn
+        sizes.add(int(size))
+    assert len(sizes) == 1, 'noise masks differ in size'
+    size = sizes.pop()
+    ppds = sorted(set(key[0] for key in masks))
+    noise_freqs = sorted(set(key[1] for key in masks), key=float)
+    n_reps = max(key[2] for key in masks) + 1
+
+    bank = create_bank(bank_fn, ppds, noise_freqs, n_reps, size)
+    available = np.zeros((len(ppds), len(noise_freqs), n_reps), dtype=bool)
+    for (ppd, freq, rep), fn in masks.items():
+        i, j = ppds.index(ppd), noise_freqs.index(freq)
+        bank[i, j, rep] = read_mask(os.path.join(noise_dir, fn))
+        available[i, j, rep] = True
+    bank.flush()
+    save_index(bank_fn, ppds, noise_freqs, available)
+
+if __name__ == '__main__':
+    # usage: python noise_bank.py noise_dir bank_fn
+    convert(sys.argv[1], sys.argv[2])
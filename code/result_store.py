@@ -0,0 +1,95 @@
+from __future__ import division
+import os
+import warnings
+import numpy as np
+
+# Columnar cache for the whitespace separated result files of the experiment
+# and the model simulations. The fields of all files are parsed once and
+# stored as one array per field in an .npz file. The cache is rebuilt whenever
+# the list of files, their modification times or their labels change.
+
+cache_dir = '../result_cache'
+
+def parse_column(values):
+    """Convert a column of strings to int, float or string, whichever fits
+    first."""
+    for dtype in [int, float]:
+        try:
+            return np.array([dtype(value) for value in values])
+        except ValueError:
+            pass
+    return np.array(values)
+
+def read_columns(fn):
+    """Read a result file into a dict of arrays, one per column. A last row
+    without line end or with missing fields was only partially written, in
+    a crash of the experiment, and is dropped with a warning. The resumed
+    session repeats that trial."""
+    with open(fn) as f:
+        names = f.readline().split()
+        lines = [line for line in f if line.strip()]
+    if lines and (not lines[-1].endswith('\n') or
+            len(lines[-1].split()) < len(names)):
+        warnings.warn('dropping incomplete last row of %s: %r' % (fn,
+            lines.pop()))
+    rows = [line.split() for line in lines]
+    return dict((name, parse_column([row[i] for row in rows])) for i, name in
+            enumerate(names))
+
+def build(fns, labels):
+    """Concatenate the columns of all files. Fields that are missing in some
+    files are dropped, as in Datamat.join()."""
+    columns = [read_columns(fn) for fn in fns]
+    names = sorted(set.intersection(*[set(column) for column in columns]))
+    fields = dict((name, np.concatenate([column[name] for column in columns]))
+                    for name in names)
+    for name, values in labels.items():
+        fields[name] = np.concatenate([[value] * len(column[names[0]])
+            for value, column in zip(values, columns)])
+    return fields
+
+def is_current(cache, fns, mtimes, labels):
+    """Check if a cache was built from the same files and labels"""
+    if list(cache['_files']) != fns or not np.array_equal(cache['_mtimes'],
+            mtimes) or sorted(cache['_labels']) != sorted(labels):
+        return False
+    return all(list(cache['_label_' + name]) == list(values) for name, values
+            in labels.items())
+
+def load(fns, cache_name, labels=None):
+    """Load the result files fns as one read-only structured array. labels
+    maps additional field names to one value per file, e.g. the observer.
+    The columns are read from the cache cache_name if it is up to date."""
+    fns = [os.path.abspath(fn) for fn in fns]
+    labels = dict(labels or {})
+    mtimes = np.array([os.path.getmtime(fn) for fn in fns])
+    cache_fn = os.path.join(cache_dir, cache_name + '.npz')
+    fields = None
+    if os.path.exists(cache_fn):
+        cache = np.load(cache_fn)
+        if is_current(cache, fns, mtimes, labels):
+            fields = dict((name, cache[name]) for name in cache.files if not
+                    name.startswith('_'))
+    if fields is None:
+        fields = build(fns, labels)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        extra = dict(('_label_' + name, values) for name, values in
+                labels.items())
+        # np.savez appends .npz to file names without it
+        tmp_fn = cache_fn[:-4] + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_fn, _files=fns, _mtimes=mtimes,
+                _labels=sorted(labels), **dict(fields, **extra))
+        os.rename(tmp_fn, cache_fn)
+    names = sorted(fields)
+    records = np.rec.fromarrays([fields[name] for name in names],
+            names=[str(name) for name in names])
+    records.flags.writeable = False
+    return records
+
+def to_datamat(records, parameters=None):
+    """Create an ocupy datamat with copies of the fields in records"""
+    from ocupy import datamat
+    fields = dict((name, np.array(records[name])) for name in
+            records.dtype.names)
+    return datamat.VectorFactory(fields, parameters or {})
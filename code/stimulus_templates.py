@@ -0,0 +1,51 @@
+from __future__ import division
+import numpy as np
+
+# Cache of the stimulus parts that only depend on a few parameters, like the
+# square wave gratings and the check backgrounds of experiment.py and
+# evaluate_models.py. Every template is built once per process and returned
+# as a read-only array, so it can be shared between trials but never be
+# changed by accident. Callers that need a modified stimulus draw into their
+# own buffer.
+
+_templates = {}
+
+def read_only(array):
+    array = np.asarray(array)
+    array.flags.writeable = False
+    return array
+
+def template(key, build):
+    """Return the template stored under key, which is created by build() on
+    first use. build may return an array or a tuple of arrays."""
+    if key not in _templates:
+        value = build()
+        if isinstance(value, tuple):
+            _templates[key] = tuple(read_only(array) for array in value)
+        else:
+            _templates[key] = read_only(value)
+    return _templates[key]
+
+def square_wave(bar_width, n_bars, grating_vals, orientation='horizontal'):
+    """Square wave grating of n_bars bars of bar_width pixels, which starts
+    with a bar of grating_vals[0] at the top (horizontal) or left (vertical).
+    For other orientations the grating is uniform at grating_vals[1]. The
+    grating is a broadcast view of a single luminance profile."""
+    def build():
+        size = bar_width * n_bars
+        profile = np.asarray(grating_vals, dtype=float)[
+                np.arange(size) // bar_width % 2]
+        if orientation == 'horizontal':
+            return np.broadcast_to(profile[:, np.newaxis], (size, size))
+        elif orientation == 'vertical':
+            return np.broadcast_to(profile, (size, size))
+        return np.broadcast_to(float(grating_vals[1]), (size, size))
+    return template(('square_wave', bar_width, n_bars,
+        tuple(float(v) for v in grating_vals), orientation), build)
+
+def upsample(values, factor):
+    """Enlarge every element of an array to a factor x factor block in the
+    first two dimensions"""
+    values = np.asarray(values)
+    return np.kron(values, np.ones((factor, factor) + (1,) *
+        (values.ndim - 2)))
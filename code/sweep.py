@@ -0,0 +1,290 @@
+from __future__ import division
+import os
+import sys
+import traceback
+import multiprocessing
+from multiprocessing import sharedctypes
+import numpy as np
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+import evaluate_models
+import batch_models
+import compose
+
+# Parallel and resumable version of evaluate_models.analyze_frequencies. Every
+# (model, grating_freq, noise_freq, rep, version) work unit stores its result
+# in a checkpoint file as soon as it is computed, so that an interrupted sweep
+# can be restarted and only evaluates the missing units. The result file is
+# written once all units are complete.
+
+checkpoint_dir = '../data/checkpoints'
+
+def work_units(model_name):
+    """List all work units of a model in the order of the result file. The
+    stimulus without noise has noise_freq None."""
+    units = []
+    for grating_freq in evaluate_models.grating_freqs:
+        for noise_freq in evaluate_models.noise_frequencies:
+            for repeat in range(25):
+                for version in [0, 1]:
+                    units.append((model_name, grating_freq, noise_freq,
+                        repeat, version))
+        units.append((model_name, grating_freq, None, 0, 0))
+    return units
+
+def model_checkpoint_dir(model_name):
+    """Checkpoint directory of a model. Checkpoints computed with different
+    noise masks are kept apart, so a sweep never mixes them."""
+    return os.path.join(checkpoint_dir, evaluate_models.noise_source(),
+            model_name)
+
+def checkpoint_fn(unit):
+    model_name, grating_freq, noise_freq, repeat, version = unit
+    if noise_freq is None:
+        condition = 'none'
+    else:
+        condition = '%1.2f_%d_%d' % (noise_freq, repeat, version)
+    return os.path.join(model_checkpoint_dir(model_name),
+            'sf%s_%s.npy' % (grating_freq, condition))
+
+def save_checkpoint(unit, value_inc, value_dec):
+    fn = checkpoint_fn(unit)
+    # write to a temporary file first, so that a crash can never leave a
+    # truncated checkpoint behind
+    with open(fn + '.tmp', 'wb') as f:
+        np.save(f, np.array([value_inc, value_dec]))
+    os.rename(fn + '.tmp', fn)
+
+def load_checkpoint(unit):
+    return np.load(checkpoint_fn(unit))
+
+# models and gratings are created once per worker process
+_models = {}
+_gratings = {}
+
+def _get_model(model_name):
+    if model_name not in _models:
+        _models[model_name] = evaluate_models.get_model(
+                evaluate_models.models.index(model_name))
+    return _models[model_name]
+
+def _get_grating(grating_freq):
+    if grating_freq not in _gratings:
+        _gratings[grating_freq] = evaluate_models.prepare_test_grating(
+                grating_freq)
+    return _gratings[grating_freq]
+
+def evaluate_units(units):
+    """Evaluate a group of work units that share model, grating frequency and
+    noise frequency as one batch, and checkpoint each unit."""
+    model_name, grating_freq, noise_freq = units[0][:3]
+    model = _get_model(model_name)
+    grating, idx_inc, idx_dec = _get_grating(grating_freq)
+    if noise_freq is None:
+        stimuli = [(grating + .5) * .5]
+    else:
+        stimuli = evaluate_models.noisy_stimuli(grating, noise_freq,
+            [(repeat, version) for _, _, _, repeat, version in units])
+    values_inc, values_dec = batch_models.patch_means(model, stimuli,
+            idx_inc, idx_dec)
+    for unit, value_inc, value_dec in zip(units, values_inc, values_dec):
+        save_checkpoint(unit, value_inc, value_dec)
+    return len(units)
+
+def pending_units(model_name):
+    """Group the work units without checkpoint by model, grating frequency and
+    noise frequency."""
+    groups = []
+    for unit in work_units(model_name):
+        if os.path.exists(checkpoint_fn(unit)):
+            continue
+        if groups and groups[-1][0][:3] == unit[:3]:
+            groups[-1].append(unit)
+        else:
+            groups.append([unit])
+    return groups
+
+def write_results(model_name):
+    """Assemble the result file of a model from its checkpoints, with the same
+    row order and trial numbering as evaluate_models.analyze_frequencies"""
+    fn = evaluate_models.result_fn(model_name)
+    with evaluate_models.open_result_file(model_name, '.tmp') as result:
+        result.write(evaluate_models.result_header)
+        for trial_nr, unit in enumerate(work_units(model_name)):
+            _, grating_freq, noise_freq, repeat, version = unit
+            value_inc, value_dec = load_checkpoint(unit)
+            result.writelines(evaluate_models.result_lines(2 * trial_nr,
+                grating_freq, value_inc, value_dec, noise_freq, repeat,
+                version))
+    os.rename(fn + '.tmp', fn)
+
+def run_sweep(model_names=tuple(evaluate_models.default_models),
+        processes=None):
+    """Evaluate all missing work units of the given models on a process pool
+    (one process per core by default), then write the result files."""
+    groups = []
+    for model_name in model_names:
+        if not os.path.isdir(model_checkpoint_dir(model_name)):
+            os.makedirs(model_checkpoint_dir(model_name))
+        groups.extend(pending_units(model_name))
+    n_units = sum(len(group) for group in groups)
+    # the workers share the noise masks of one noise bank
+    evaluate_models.prepare_noise()
+    pool = multiprocessing.Pool(processes)
+    try:
+        done = 0
+        for n in pool.imap_unordered(evaluate_units, groups):
+            done += n
+            sys.stdout.write('\rcompleted %d of %d work units' % (done,
+                n_units))
+            sys.stdout.flush()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    for model_name in model_names:
+        write_results(model_name)
+
+# Evaluation of several models on the same stimuli. The stimuli of a
+# (grating_freq, noise_freq) pair are composed once into a shared memory
+# buffer, which one worker process per model reads without copying. While
+# the models evaluate one buffer, the next stack is composed into the other.
+
+def stimulus_jobs():
+    """List the (grating_freq, noise_freq, conditions) stacks of stimuli in
+    the order of the result file. The stimulus without noise has noise_freq
+    None."""
+    conditions = [(repeat, version) for repeat in range(25)
+                    for version in [0, 1]]
+    jobs = []
+    for grating_freq in evaluate_models.grating_freqs:
+        for noise_freq in evaluate_models.noise_frequencies:
+            jobs.append((grating_freq, noise_freq, conditions))
+        jobs.append((grating_freq, None, [(0, 0)]))
+    return jobs
+
+def shared_stack(buffer, stack_shape, writeable=True):
+    stack = np.frombuffer(buffer, dtype='float64').reshape(stack_shape)
+    stack.flags.writeable = writeable
+    return stack
+
+def model_worker(model_name, buffers, stack_shape, tasks, results):
+    """Evaluate a model on the stacks in the shared buffers. tasks yields
+    (buffer_nr, grating_freq, n_stimuli) until None, and the patch means of
+    each task, or the traceback of an error, are put in results."""
+    try:
+        model = _get_model(model_name)
+        # the stimuli are shared with the other models and must stay intact
+        stacks = [shared_stack(buffer, stack_shape, writeable=False)
+                    for buffer in buffers]
+        for buffer_nr, grating_freq, n_stimuli in iter(tasks.get, None):
+            _, idx_inc, idx_dec = _get_grating(grating_freq)
+            values = batch_models.patch_means(model,
+                    stacks[buffer_nr][:n_stimuli], idx_inc, idx_dec)
+            results.put((model_name, buffer_nr, values))
+    except Exception:
+        results.put((model_name, None, traceback.format_exc()))
+
+def collect_result(results, workers, pending, values):
+    """Wait for the next result of a worker and store it in values. A buffer
+    is removed from pending once all models are done with it."""
+    while True:
+        try:
+            model_name, buffer_nr, result = results.get(timeout=1)
+            break
+        except Empty:
+            if not all(worker.is_alive() for worker in workers):
+                raise RuntimeError('a model worker died')
+    if buffer_nr is None:
+        raise RuntimeError('evaluation of %s failed:\n%s' % (model_name,
+            result))
+    job_nr, n_models = pending[buffer_nr]
+    values[model_name][job_nr] = result
+    if n_models == 1:
+        del pending[buffer_nr]
+    else:
+        pending[buffer_nr] = job_nr, n_models - 1
+
+def run_shared(model_names=tuple(evaluate_models.default_models),
+        n_buffers=2):
+    """Evaluate the models on all stimuli of
+    evaluate_models.analyze_frequencies and write their result files, while
+    every stimulus is only created once."""
+    jobs = stimulus_jobs()
+    stack_shape = (max(len(conditions) for _, _, conditions in jobs),
+            512, 512)
+    buffers = [sharedctypes.RawArray('d', int(np.prod(stack_shape)))
+                for _ in range(n_buffers)]
+    stacks = [shared_stack(buffer, stack_shape) for buffer in buffers]
+    tasks = dict((model_name, multiprocessing.Queue()) for model_name in
+            model_names)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=model_worker,
+                    args=(model_name, buffers, stack_shape, tasks[model_name],
+                        results))
+                for model_name in model_names]
+    values = dict((model_name, {}) for model_name in model_names)
+    # buffer_nr -> (job_nr, number of models that still evaluate it)
+    pending = {}
+    for worker in workers:
+        worker.start()
+    try:
+        for job_nr, (grating_freq, noise_freq, conditions) in enumerate(jobs):
+            buffer_nr = job_nr % n_buffers
+            while buffer_nr in pending:
+                collect_result(results, workers, pending, values)
+            grating = _get_grating(grating_freq)[0]
+            stack = stacks[buffer_nr][:len(conditions)]
+            if noise_freq is None:
+                compose.grating_in_noise(grating, out=stack[0])
+            else:
+                evaluate_models.noisy_stimuli(grating, noise_freq,
+                        conditions, stack)
+            pending[buffer_nr] = job_nr, len(model_names)
+            for model_name in model_names:
+                tasks[model_name].put((buffer_nr, grating_freq,
+                    len(conditions)))
+            sys.stdout.write('\rcomposed %d of %d stimulus stacks' % (
+                job_nr + 1, len(jobs)))
+            sys.stdout.flush()
+        while pending:
+            collect_result(results, workers, pending, values)
+        sys.stdout.write('\n')
+        for model_name in model_names:
+            tasks[model_name].put(None)
+    except:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+    for model_name in model_names:
+        write_shared_results(model_name, jobs, values[model_name])
+
+def write_shared_results(model_name, jobs, values):
+    """Write the result file of a model from the patch means of all jobs,
+    like write_results"""
+    fn = evaluate_models.result_fn(model_name)
+    trial_nr = 0
+    with evaluate_models.open_result_file(model_name, '.tmp') as result:
+        result.write(evaluate_models.result_header)
+        for job_nr, (grating_freq, noise_freq, conditions) in enumerate(jobs):
+            for (repeat, version), value_inc, value_dec in zip(conditions,
+                    *values[job_nr]):
+                result.writelines(evaluate_models.result_lines(trial_nr,
+                    grating_freq, value_inc, value_dec, noise_freq, repeat,
+                    version))
+                trial_nr += 2
+    os.rename(fn + '.tmp', fn)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--shared']:
+        run_shared(sys.argv[2:] or evaluate_models.default_models)
+    else:
+        run_sweep(sys.argv[1:] or evaluate_models.default_models)
@@ -19,10 +19,22 @@ import os
 import time
 import random
 import glob
+import itertools
+import json
+import threading
+import collections
+import Queue
 import Image, ImageFont, ImageDraw
 
 from stimuli import utils
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'code'))
+import noise_bank
+import adjustment_trace
+import stimulus_templates
+import compose
+
 class EndTrial(Exception):
     def __init__(self, match_lum, view_count):
         self.match_lum = match_lum
@@ -51,29 +63,175 @@ def draw_centered(texture):
     x = (1024 - texture.wdth) / 2
     texture.draw((x, y))
 
-def waitButton(datapixx, to):
-    """wait for a button press for a given time, and return the button identity
-    as first element in a tuple to match hrl API. if no button was pressed,
-    button identity is None. This function is only needed until
-    hrl.inputs.readButton() is fixed"""
-    t = time.time()
-    while time.time() - t < to:
-        btn = datapixx.readButton()
-        if btn is None:
-            time.sleep(max(0, min(.01, to - time.time() + t)))
-            continue
-        btn = btn[0]
-        if btn == 2: #up
-            return ('Up', 0)
-        elif btn == 1: #right
-            return ('Right', 0)
-        elif btn == 8: #down
-            return ('Down', 0)
-        elif btn == 4: #left
-            return ('Left', 0)
-        elif btn == 16: #space
-            return ('Space', 0)
-    return (None, 0)
+# button codes of the ResponsePixx box
+button_names = {2: 'Up', 1: 'Right', 8: 'Down', 4: 'Left', 16: 'Space'}
+
+class ResponseBox(object):
+    """Event driven replacement for hrl.inputs.readButton(), which is only
+    needed until that is fixed. A reader thread polls the response box of
+    datapixx and puts every button press, with its time, into a queue, from
+    which readButton takes them. Press times are in host time, like the
+    time.time() stamps of the trace. The time stamp of the device (if it has
+    one) is converted to host time with the clock offset estimated from the
+    last sync_window presses. The device is only read while holding
+    device_lock, which the other users of the DATAPixx have to hold as
+    well, because its driver is not known to be thread safe."""
+
+    def __init__(self, datapixx, poll_interval=.001, sync_window=32):
+        self.datapixx = datapixx
+        self.poll_interval = poll_interval
+        self.offsets = collections.deque(maxlen=sync_window)
+        self.events = Queue.Queue()
+        self.device_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.device_lock:
+                btn = self.datapixx.readButton()
+            if btn is None:
+                time.sleep(self.poll_interval)
+            elif btn[0] in button_names:
+                press_time = time.time()
+                if len(btn) > 1 and btn[1] is not None:
+                    press_time = self.host_time(press_time, btn[1])
+                self.events.put((button_names[btn[0]], press_time))
+
+    def host_time(self, read_time, device_time):
+        """Convert the device time stamp of a press that was read at
+        read_time to host time. A press is read at most a poll interval
+        after it happened, unless the reader is delayed, so the smallest
+        difference between read time and device time of the recent presses
+        is the best estimate of the clock offset. The window follows a drift
+        of the clocks."""
+        self.offsets.append(read_time - device_time)
+        return device_time + min(self.offsets)
+
+    def readButton(self, to):
+        """wait for a button press for a given time, and return the button
+        identity and the time of the press, to match hrl API. if no button
+        was pressed, button identity is None."""
+        # a get() with timeout polls in steps of up to 50ms on python 2, so
+        # we block without timeout and let a timer post the end of the wait
+        timeout = object()
+        timer = threading.Timer(to, self.events.put, [timeout])
+        timer.daemon = True
+        timer.start()
+        try:
+            while True:
+                event = self.events.get()
+                if event is timeout:
+                    return (None, 0)
+                # skip the timeouts of earlier calls that ended with a press
+                if isinstance(event, tuple):
+                    return event
+        finally:
+            timer.cancel()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def serialized(lock, func):
+    """Wrap func to be called only while holding lock"""
+    def locked(*args, **kwargs):
+        with lock:
+            return func(*args, **kwargs)
+    return locked
+
+class StimulusPrefetcher(object):
+    """Iterate over the trials in designs, tuples like (trial, dsgn, ...)
+    whose second element is the design row, with the stimulus of the trial
+    appended to each tuple. A background thread reads ahead in designs and
+    prepares the stimuli of the next n_ahead trials with prepare(dsgn), so
+    that a trial only has to upload its stimulus texture. With buffer_shape,
+    the stimuli are composed in a ring of preallocated buffers by
+    prepare(dsgn, out=buffer). A buffer is reused once the trial that got it
+    is over, so a stimulus must not be used after the next one was taken."""
+
+    def __init__(self, designs, prepare, n_ahead=3, buffer_shape=None,
+            buffer_dtype='float32'):
+        self.queue = Queue.Queue(n_ahead)
+        if buffer_shape is not None:
+            # n_ahead stimuli in the queue, one in the current trial and one
+            # that is being prepared
+            buffers = itertools.cycle(np.empty((n_ahead + 2,) +
+                tuple(buffer_shape), dtype=buffer_dtype))
+            prepare_into = prepare
+            prepare = lambda dsgn: prepare_into(dsgn, out=next(buffers))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                args=(designs, prepare))
+        # do not keep the experiment alive if it ends before the design
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, designs, prepare):
+        try:
+            for trial in designs:
+                if not self.put(('trial', trial + (prepare(trial[1]),))):
+                    return
+        except Exception:
+            self.put(('error', sys.exc_info()))
+            return
+        self.put(('done', None))
+
+    def put(self, item):
+        """Wait for a free slot in the queue, unless we are stopped"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        while True:
+            kind, item = self.queue.get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                # re-raise exceptions of the prefetch thread in the main thread
+                raise item[0], item[1], item[2]
+            yield item
+
+class TexturePool(object):
+    """Textures that are created once and reused for the whole session.
+    Uniform textures (fixation dots, match patch) are kept per luminance,
+    which is quantized to steps of 1 / resolution, so that adjusting the
+    match patch never allocates more than resolution + 1 textures."""
+
+    def __init__(self, graphics, resolution=1000):
+        self.graphics = graphics
+        self.resolution = resolution
+        self.textures = {}
+
+    def quantize(self, lum):
+        """Round a luminance to the luminance steps of the pool"""
+        return round(lum * self.resolution) / float(self.resolution)
+
+    def get(self, key, create, shape=None):
+        """Return the texture for key. The first time, it is created from
+        the array returned by create()."""
+        if key not in self.textures:
+            if shape is None:
+                self.textures[key] = self.graphics.newTexture(create())
+            else:
+                self.textures[key] = self.graphics.newTexture(create(), shape)
+        return self.textures[key]
+
+    def uniform(self, lum, shape=None):
+        """Return a 1x1 texture of the (quantized) luminance lum"""
+        step = int(round(lum * self.resolution))
+        return self.get(('uniform', step, shape),
+                lambda: np.ones((1, 1)) * step / float(self.resolution), shape)
 
 ### Main ###
 def create_design(design_fn, grating_freq):
@@ -114,6 +272,51 @@ def create_design(design_fn, grating_freq):
             design_file.write(' '.join(trial) + '\r\n')
     return total_trials
 
+def read_design(design_fn, first_trial=0, offset=None):
+    """Yield (trial, dsgn, next_offset) for the trials of a design file from
+    first_trial on, where dsgn maps the fields of the header to the values
+    of the trial and next_offset is the position of the next trial in the
+    file. If the position offset of first_trial is known, the file is read
+    from there, instead of skipping the earlier trials."""
+    with open(design_fn, 'rb') as design_file:
+        fields = design_file.readline().split()
+        trial = 0
+        if offset is not None:
+            design_file.seek(offset)
+            trial = first_trial
+        while True:
+            line = design_file.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            if trial >= first_trial:
+                yield trial, dict(zip(fields, line.split())), design_file.tell()
+            trial += 1
+
+def session_index_fn(design_fn):
+    return os.path.splitext(design_fn)[0] + '_session.json'
+
+def read_session_index(design_fn):
+    with open(session_index_fn(design_fn)) as index_file:
+        return json.load(index_file)
+
+def write_session_index(design_fn, completed_trials, total_trials, part,
+        design_offset):
+    """Store the progress of a subject: the number of completed trials, the
+    total number of trials, the part number of the current result file and
+    the position of the next trial in the design file. The index is replaced
+    atomically, so a crash leaves either the old or the new index."""
+    fn = session_index_fn(design_fn)
+    with open(fn + '.tmp', 'w') as index_file:
+        json.dump({'completed_trials': completed_trials,
+                   'total_trials': total_trials,
+                   'part': part,
+                   'design_offset': design_offset}, index_file)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.rename(fn + '.tmp', fn)
+
 def prepare_files():
     vp_id  = raw_input ('VP Initialen (z.B. mm): ')
     grating_contrast = ''
@@ -129,67 +332,76 @@ def prepare_files():
             grating_freq, grating_contrast * 10)
     # check if we are resuming with a know subject and take appropriate action
     completed_trials = 0
+    design_offset = None
     if os.access(design_fn, os.F_OK):
         reply = raw_input('Es gibt bereits Daten zu dieser VP. Weiter? (j/n)')
         if reply != 'j':
             raise EndExperiment()
-        filecount = -1
-        for filecount, fn in enumerate(
-                    glob.glob(os.path.join(result_dir, '*%s*.csv' % vp_id))):
-            with open(fn) as result_file:
-                # first line in the result file is not a trial
-                completed_trials -= 1
-                for line in result_file:
-                    completed_trials += 1
+        if os.access(session_index_fn(design_fn), os.F_OK):
+            index = read_session_index(design_fn)
+            completed_trials = index['completed_trials']
+            total_trials = index['total_trials']
+            design_offset = index['design_offset']
+            part = index['part'] + 1
+        else:
+            # sessions from before the session index: count the trials in
+            # the result files and the design file
+            filecount = -1
+            for filecount, fn in enumerate(
+                        glob.glob(os.path.join(result_dir, '*%s*.csv' %
+                            vp_id))):
+                with open(fn) as result_file:
+                    # first line in the result file is not a trial
+                    completed_trials -= 1
+                    for line in result_file:
+                        completed_trials += 1
+            part = filecount + 2
+            # count number of trials in design file
+            total_trials = -1
+            with open(design_fn) as design_file:
+                for line in design_file:
+                    total_trials += 1
         result_fn = os.path.join(result_dir, 'noise_matching_%s_%d.csv' %
-                (vp_id, filecount + 2))
-        # count number of trials in design file
-        total_trials = -1
-        with open(design_fn) as design_file:
-            for line in design_file:
-                total_trials += 1
+                (vp_id, part))
         check_fn = 'check_files/fast_matching/%s/sf_%s/contrast%d/noise_matching_%d.csv' % \
-            (vp_id, grating_freq, grating_contrast * 10, filecount + 2)
+            (vp_id, grating_freq, grating_contrast * 10, part)
     # if we are not resuming, create design file
     else:
         os.makedirs(result_dir)
+        part = 1
         result_fn = os.path.join(result_dir, 'noise_matching_%s_1.csv' % vp_id)
         total_trials = create_design(design_fn, grating_freq)
         check_fn = 'check_files/fast_matching/%s/sf_%s/contrast%d/noise_matching_%d.csv' % \
             (vp_id, grating_freq, grating_contrast * 10, 1)
         os.makedirs(os.path.split(check_fn)[0])
+    # claim the part number of this session's result file right away
+    write_session_index(design_fn, completed_trials, total_trials, part,
+            design_offset)
     return (design_fn, result_fn, completed_trials, total_trials, check_fn,
-            grating_contrast, grating_freq)
+            grating_contrast, grating_freq, part, design_offset)
 
 def prepare_grating(grating_ori, grating_vals, check_pos, check_val,
                         bar_width=38, n_bars=6):
-    # create square wave grating
-    grating = np.ones((bar_width * n_bars, bar_width * n_bars)) * grating_vals[1]
-    index = [i + j for i in range(bar_width) for j in
-                range(0, bar_width * n_bars, bar_width * 2)]
-    if grating_ori == 'vertical':
-        grating[:, index] = grating_vals[0]
-    elif grating_ori == 'horizontal':
-        grating[index, :] = grating_vals[0]
-    # place test square at appropriate position
-    y, x = check_pos
-    grating[y:y+bar_width, x:x+bar_width] = check_val
-    return grating
-
-def add_noise(grating, noise_freq, noise_shape, rep, ppd, noise_type):
-    if noise_type == 'none':
-        noise = np.zeros((noise_shape, noise_shape))
-    else:
-        noise = np.load('noisemasks/noise%d_%dppd_%1.2f_%d.npy' % (noise_shape,
-            ppd, noise_freq, rep % 5 + 1))
-    # rotate noise mask 180deg on second half of repetitions
-    if rep >= 5:
-        noise = noise[::-1, ::-1]
-    if noise_type in ['global', 'none']:
-        mask = 1
-    else:
-        mask = np.zeros_like(noise)
-        offset = (noise_shape - grating.shape[0]) / 2
+    """Square wave grating with the test square at check_pos. The few
+    distinct gratings of a session are built once and returned read-only."""
+    def build():
+        grating = np.array(stimulus_templates.square_wave(bar_width, n_bars,
+            grating_vals, grating_ori))
+        # place test square at appropriate position
+        y, x = check_pos
+        grating[y:y+bar_width, x:x+bar_width] = check_val
+        return grating
+    return stimulus_templates.template(('grating', grating_ori,
+        tuple(float(v) for v in grating_vals), tuple(check_pos),
+        float(check_val), bar_width, n_bars), build)
+
+def local_noise_mask(noise_type, noise_shape, grating_size):
+    """Window that restricts horizontal and vertical noise to the bars next
+    to the test squares. The masks only depend on the noise type and the
+    sizes of noise and grating, so each one is created once per session."""
+    def build():
+        mask = np.zeros((noise_shape, noise_shape))
+        offset = (noise_shape - grating_size) / 2
         if noise_type == 'horizontal':
             mask_coords1 = ((offset + 3 * 40 - 1, offset + 2.5 * 40 - 1),
                             (offset + 3 * 40 + 1, offset + 3.5 * 40 + 1))
@@ -200,20 +412,42 @@ def add_noise(grating, noise_freq, noise_shape, rep, ppd, noise_type):
                             (offset + 4 * 40 + 1, offset + 2.5 * 40 + 1))
             mask_coords2 = ((offset + 3 * 40 - 1, offset + 3.5 * 40 - 1),
                             (offset + 4 * 40 + 1, offset + 3.5 * 40 + 1))
-        mask += utils.smooth_window(noise.shape, mask_coords1, 0, 1, 16)
-        mask += utils.smooth_window(noise.shape, mask_coords2, 0, 1, 16)
-    noise_masked = noise * mask + .5
-    stim = np.ones_like(noise) * .5
-    y_border = (stim.shape[0] - grating.shape[0]) / 2.
-    x_border = (stim.shape[1] - grating.shape[1]) / 2.
-    assert y_border == int(y_border)
-    assert x_border == int(x_border)
-    stim[y_border:-y_border, x_border:-x_border] = grating
-    stim_in_noise = .5 * (stim+noise_masked)
-    return np.fmin(np.fmax(0, stim_in_noise), 1)
+        mask += utils.smooth_window(mask.shape, mask_coords1, 0, 1, 16)
+        mask += utils.smooth_window(mask.shape, mask_coords2, 0, 1, 16)
+        return mask
+    return stimulus_templates.template(('noise_mask', noise_type,
+        noise_shape, grating_size), build)
+
+def open_noise_bank(noise_shape):
+    """Open the bank of the noise masks of a size. The bank is created from
+    the .npy noise masks, see the README."""
+    bank_fn = 'noisemasks/noise%d_bank.npy' % noise_shape
+    if not os.path.exists(bank_fn):
+        raise IOError('noise bank %s not found, create it from the noise '
+                'masks with: python code/noise_bank.py noisemasks %s' % (
+                    bank_fn, bank_fn))
+    return noise_bank.open_bank(bank_fn)
+
+def add_noise(grating, noise_freq, noise_shape, rep, ppd, noise_type,
+        out=None):
+    """Embed the grating in noise, composed in place in out (by default a new
+    float32 array, like the noise masks)."""
+    if out is None:
+        out = np.empty((noise_shape, noise_shape), dtype='float32')
+    noise = None
+    mask = None
+    if noise_type != 'none':
+        noise = open_noise_bank(noise_shape).get(ppd, noise_freq, rep % 5)
+    if noise_type not in ['global', 'none']:
+        mask = local_noise_mask(noise_type, noise_shape, grating.shape[0])
+    # rotate noise mask 180deg on second half of repetitions
+    return compose.grating_in_noise(grating, noise, out, flip=rep >= 5,
+            mask=mask)
 
 def prepare_check_background(grating_vals):
-    # create random checks as background for match patch
+    """Random checks as background for the match patch. The background is
+    built once per luminance range; a trial gets a randomly flipped
+    read-only view of it."""
     lum_range = np.abs(np.diff(grating_vals))
     checks = np.array(
               [[0, 5, 0, 1, 3, 0],
@@ -222,15 +456,14 @@ def prepare_check_background(grating_vals):
                [4, 1, 2, 4, 2, 5],
                [5, 4, 0, 1, 5, 3],
                [0, 3, 5, 0, 4, 2]], dtype=int)
-
-    values = np.linspace(.5 - lum_range, .5 + lum_range, 6)
+    values = np.linspace(.5 - lum_range, .5 + lum_range, 6)[checks]
+    check_bg = stimulus_templates.template(('check_background', tuple(lum_range)),
+            lambda: stimulus_templates.upsample(values, 25))
     # flip horizontally with probability .5
-    checks = checks[:, ::np.round(np.random.rand()) * 2 - 1]
+    x_step = int(np.round(np.random.rand())) * 2 - 1
     # flip vertically with probability .5
-    checks = checks[::np.round(np.random.rand()) * 2 - 1, :]
-    checks = values[checks]
-    check_bg = np.repeat(np.repeat(checks, 25, 0), 25, 1)
-    return check_bg, checks.flatten()
+    y_step = int(np.round(np.random.rand())) * 2 - 1
+    return check_bg[::y_step, ::x_step], values[::y_step, ::x_step].flatten()
 
 def adjust_loop(match_lum, match_pos, grating, match_bg):
     """ react to button presses and adjust match luminance accordingly for a
@@ -239,14 +472,15 @@ def adjust_loop(match_lum, match_pos, grating, match_bg):
     """
     smlstp = 0.01
     bgstp = 0.05
-    fix_inner = hrl.graphics.newTexture(np.ones((1,1)) * .5, 'circle')
-    fix_outer = hrl.graphics.newTexture(np.ones((1,1)) * .3, 'circle')
+    fix_inner = textures.uniform(.5, 'circle')
+    fix_outer = textures.uniform(.3, 'circle')
     match_bg.draw(match_bg_loc)
-    match_patch = hrl.graphics.newTexture(np.ones((1,1)) * match_lum)
+    match_patch = textures.uniform(match_lum)
     match_patch.draw(match_pos, (74, 74))
     fix_outer.draw((512, 383.5 + bar_width / 2), (10, 10))
     fix_inner.draw((512, 383.5 + bar_width / 2), (4, 4))
     hrl.graphics.flip(clr=False)
+    trace.log('match', match_lum)
     time.sleep(.7)
     view_count = 0
     while True:
@@ -254,17 +488,19 @@ def adjust_loop(match_lum, match_pos, grating, match_bg):
         grating.draw(stim_loc)
         view_count += 1
         hrl.graphics.flip(clr=True)
+        trace.log('stimulus', match_lum)
         time.sleep(.5)
         match_bg.draw(match_bg_loc)
-        match_patch = hrl.graphics.newTexture(np.ones((1,1)) * match_lum)
+        match_patch = textures.uniform(match_lum)
         match_patch.draw(match_pos, (74, 74))
         fix_outer.draw((512, 383.5 + bar_width / 2), (10, 10))
         fix_inner.draw((512, 383.5 + bar_width / 2), (4, 4))
         hrl.graphics.flip(clr=False)
+        trace.log('match', match_lum)
         # Read the next button press
         btn = None
         while not btn == 'Space':
-            btn, _ = hrl.inputs.readButton(36000)
+            btn, btn_time = hrl.inputs.readButton(36000)
             if hrl.inputs.checkEscape():
                 raise EndExperiment('escape pressed')
             # Respond to the pressed button
@@ -276,13 +512,18 @@ def adjust_loop(match_lum, match_pos, grating, match_bg):
                 match_lum -= bgstp
             elif btn == 'Left':
                 match_lum -= smlstp
-            match_lum = min(max(match_lum, 0), 1)
-            match_patch = hrl.graphics.newTexture(np.ones((1,1)) * match_lum)
+            # stay on the luminance steps of the texture pool
+            match_lum = textures.quantize(min(max(match_lum, 0), 1))
+            match_patch = textures.uniform(match_lum)
             match_patch.draw(match_pos, (74, 74))
             hrl.graphics.flip(clr=False)
+            if btn is not None:
+                trace.log('match', match_lum, btn, btn_time)
         if hrl.inputs.checkEscape():
             raise EndExperiment('escape pressed')
-        btn2, _ = hrl.inputs.readButton(.3)
+        btn2, btn_time = hrl.inputs.readButton(.3)
+        if btn2 is not None:
+            trace.log('match', match_lum, btn2, btn_time)
         if btn2 == 'Space':
             raise EndTrial(match_lum, view_count)
     if hrl.inputs.checkEscape():
@@ -311,8 +552,10 @@ def show_break(trial, total_trials):
         if hrl.inputs.checkEscape():
             raise EndExperiment('escape pressed')
 
-def run_trial(dsgn, grating_freq, noise_shape, grating_contrast):
-    # prepare a test stimulus texture
+def prepare_stimulus(dsgn, grating_freq, noise_shape, grating_contrast,
+        out=None):
+    """Create the test stimulus of a trial: the grating embedded in noise,
+    composed in out if given"""
     grating_vals = [float(v) for v in dsgn['grating_vals'].split(',')]
     grating_vals = .5 + grating_contrast * np.asarray(grating_vals) / 2
     check_pos = (n_bars / 2 * bar_width, (n_bars / 2 - .5) * bar_width)
@@ -330,9 +573,23 @@ def run_trial(dsgn, grating_freq, noise_shape, grating_contrast):
                       noise_shape,
                       int(dsgn['rep']),
                       ppd,
-                      dsgn['noise_type'])
+                      dsgn['noise_type'],
+                      out)
+    return grating
 
-    grating = hrl.graphics.newTexture(grating)
+def start_adjustment(match_initial):
+    """Called by run_trial with the initial luminance of the match patch,
+    before the subject adjusts it. simulation.py replaces it, to let the
+    simulated observer plan its button presses."""
+    pass
+
+def run_trial(dsgn, grating_freq, noise_shape, grating_contrast,
+        stimulus=None):
+    # prepare a test stimulus texture, unless it was prepared in advance
+    if stimulus is None:
+        stimulus = prepare_stimulus(dsgn, grating_freq, noise_shape,
+                grating_contrast)
+    grating = hrl.graphics.newTexture(stimulus)
     # prepare and draw the matching background for this trial
     match_bg, bg_values = prepare_check_background([.4, .6])
     match_pos = (match_bg_offset + match_bg.shape[1] / 2 - 37,
@@ -340,8 +597,9 @@ def run_trial(dsgn, grating_freq, noise_shape, grating_contrast):
     match_bg = hrl.graphics.newTexture(match_bg)
 
     # initialize match patch with random value, save it to resultdict
-    match_lum = (np.random.random() * .2) + .4
+    match_lum = textures.quantize((np.random.random() * .2) + .4)
     hrl.results['match_initial'] = float(match_lum)
+    start_adjustment(float(match_lum))
     # place match patch same distance below center as test patch above
 
     # preload some variables to prepare for our button reading loop.
@@ -363,43 +621,63 @@ def run_trial(dsgn, grating_freq, noise_shape, grating_contrast):
             hrl.graphics.flip(clr=True)
             draw_centered(confirmation)
             hrl.graphics.flip(clr=True)
-            btn, _ = hrl.inputs.readButton(to=36000.)
+            trace.log('confirmation', match_lum)
+            btn, btn_time = hrl.inputs.readButton(to=36000.)
+            if btn is not None:
+                trace.log('confirmation', match_lum, btn, btn_time)
             if btn == 'Space':
                 trial_over = True
     return match_lum, view_count, bg_values
 
-def main():
+def create_hrl(design_fn, result_fn, result_headers):
+    return HRL(graphics='datapixx',
+               inputs='responsepixx',
+               photometer=None,
+               wdth=1024,
+               hght=768,
+               bg=0.5,
+               dfl=design_fn,
+               rfl=result_fn,
+               rhds=result_headers,
+               scrn=1,
+               lut='lut0to88.csv',
+               db = False,
+               fs=True)
+
+def main(session=None, create_hrl=create_hrl, intro=True):
+    """Run a session. session is the tuple returned by prepare_files(),
+    which asks for it by default. create_hrl(design_fn, result_fn,
+    result_headers) creates the hrl object, which can be replaced by a
+    stand-in, see simulation.py. With intro, the instructions and practice
+    trials of new subjects and the start screen are shown."""
     # determine design and result file name
-    try:
-        (design_fn, result_fn, completed_trials, total_trials, check_fn,
-                grating_contrast, grating_freq) = prepare_files()
-    except EndExperiment:
-        return 0
+    if session is None:
+        try:
+            session = prepare_files()
+        except EndExperiment:
+            return 0
+    (design_fn, result_fn, completed_trials, total_trials, check_fn,
+            grating_contrast, grating_freq, part, design_offset) = session
     result_headers = ['Trial', 'noise_type', 'coaxial_lum', 'test_lum',
                       'match_lum', 'response_time', 'match_initial',
                       'grating_freq', 'grating_contrast', 'noise_freq',
                       'rep', 'view_count']
+    noise_shape = 512
+    # fail before the display is opened if the noise masks are missing
+    open_noise_bank(noise_shape)
     global hrl
-    hrl = HRL(graphics='datapixx',
-              inputs='responsepixx',
-              photometer=None,
-              wdth=1024,
-              hght=768,
-              bg=0.5,
-              dfl=design_fn,
-              rfl=result_fn,
-              rhds=result_headers,
-              scrn=1,
-              lut='lut0to88.csv',
-              db = False,
-              fs=True)
+    hrl = create_hrl(design_fn, result_fn, result_headers)
 
     # monkey patch to use non-blocking readButton function
     # should be removed once hrl.inputs.readButton is fixed
-    hrl.inputs.readButton = lambda to: waitButton(hrl.datapixx, to)
+    response_box = ResponseBox(hrl.datapixx)
+    hrl.inputs.readButton = response_box.readButton
+    # the display flips go through the DATAPixx as well, so they must not
+    # overlap with the reads of the response box thread
+    hrl.graphics.flip = serialized(response_box.device_lock,
+            hrl.graphics.flip)
 
     # set the bar width of the grating. this value determines all positions
-    noise_shape = 512
     global bar_width
     global n_bars
     if grating_freq == '1.6':
@@ -427,14 +705,24 @@ def main():
     global stim_loc
     stim_loc = (x_border, y_border)
 
+    # binary trace of all adjustments, next to the check files. Practice
+    # trials are logged as trial -1.
+    global trace
+    trace = adjustment_trace.TraceWriter(os.path.splitext(
+        check_fn.replace('check_files', 'trace_files', 1))[0] + '.trace')
+
+    # textures that are reused in every trial
+    global textures
+    textures = TexturePool(hrl.graphics)
     # prepare confirmation texture
     global confirmation
     #confirmation = hrl.graphics.newTexture(draw_text('Quadrat gesehen? Rechts '
     #    'ja, links nein', bg=.5))
-    confirmation = hrl.graphics.newTexture(draw_text('Weiter?', bg=.5))
+    confirmation = textures.get('confirmation',
+            lambda: draw_text('Weiter?', bg=.5))
 
     # show instruction screen
-    if completed_trials == 0:
+    if intro and completed_trials == 0:
         for i in range(0):
             instructions = plt.imread('instructions/instructions%d.png' %
                                 (i + 1))[..., 0]
@@ -481,36 +769,36 @@ def main():
             run_trial(dsgn, grating_freq, 512, grating_contrast)
 
     # show experiment start confirmation
-    hrl.graphics.flip(clr=True)
-    lines = [u'Die Probedurchgänge sind fertig.',
-        u'Wenn du bereit bist, drücke die mittlere Taste.',
-        u' ',
-        u'Wenn du noch Fragen hast, oder mehr Probedurchgänge',
-        u'machen willst, wende dich an den Versuchsleiter.']
-    for line_nr, line in enumerate(lines):
-        textline = hrl.graphics.newTexture(draw_text(line, fontsize=36))
-        textline.draw(((1024 - textline.wdth) / 2,
-                       (768 / 2 - (3 - line_nr) * (textline.hght + 10))))
-    hrl.graphics.flip(clr=True)
-    btn = None
-    while btn != 'Space':
-        btn, _ = hrl.inputs.readButton(to=3600)
+    if intro:
+        hrl.graphics.flip(clr=True)
+        lines = [u'Die Probedurchgänge sind fertig.',
+            u'Wenn du bereit bist, drücke die mittlere Taste.',
+            u' ',
+            u'Wenn du noch Fragen hast, oder mehr Probedurchgänge',
+            u'machen willst, wende dich an den Versuchsleiter.']
+        for line_nr, line in enumerate(lines):
+            textline = hrl.graphics.newTexture(draw_text(line, fontsize=36))
+            textline.draw(((1024 - textline.wdth) / 2,
+                           (768 / 2 - (3 - line_nr) * (textline.hght + 10))))
+        hrl.graphics.flip(clr=True)
+        btn = None
+        while btn != 'Space':
+            btn, _ = hrl.inputs.readButton(to=3600)
 
     ### Core Loop ###
 
-    # hrl.designs is an iterator over all the lines in the specified design
-    # matrix, which was loaded at the creation of the hrl object. Looping over
-    # it in a for statement provides a nice way to run each line in a design
-    # matrix. The fields of each design line (dsgn) are drawn from the design
-    # matrix in the design file (design.csv).
-
+    # read_design iterates over the lines in the design file, starting at the
+    # first trial that we do not have data for yet. The fields of each design
+    # line (dsgn) are drawn from the design matrix in the design file.
+    # The stimuli of the next trials are prepared in the background.
+    prefetcher = StimulusPrefetcher(read_design(design_fn, completed_trials,
+                design_offset),
+            lambda dsgn, out: prepare_stimulus(dsgn, grating_freq,
+                noise_shape, grating_contrast, out),
+            buffer_shape=(noise_shape, noise_shape))
     start_time = time.time()
     try:
-        for trial, dsgn in enumerate(hrl.designs):
-
-            # skip trials that we already had data for
-            if trial < completed_trials:
-                continue
+        for trial, dsgn, design_offset, stimulus in prefetcher:
 
             # check if we should take a break (every 15 minutes)
             if time.time() - start_time > (60 * 15):
@@ -518,8 +806,9 @@ def main():
                 start_time = time.time()
 
             trial_start = time.time()
+            trace.trial = trial
             match_lum, view_count, bg_values = run_trial(dsgn, grating_freq,
-                    noise_shape, grating_contrast)
+                    noise_shape, grating_contrast, stimulus)
             response_time = time.time() - trial_start
 
             grating_vals = [float(v) for v in dsgn['grating_vals'].split(',')]
@@ -540,10 +829,15 @@ def main():
             hrl.results['rep'] = dsgn['rep']
             hrl.results['view_count'] = view_count
             hrl.writeResultLine()
+            # record the progress right after the result line, to resume
+            # after the last completed trial without repeating it
+            write_session_index(design_fn, trial + 1, total_trials, part,
+                    design_offset)
 
             # write match bg values to file
             with open(check_fn, 'a') as f:
                 f.write('%s\n' %','.join('%0.4f' % x for x in bg_values))
+            trace.flush()
 
             # We print the trial number simply to keep track during an experiment
             print hrl.results['Trial']
@@ -551,6 +845,12 @@ def main():
     # catch EndExperiment exception raised by pressing escp for clean exit
     except EndExperiment:
         print "Experiment aborted"
+    finally:
+        # stop the background threads and keep the buffered trace records,
+        # also if the session ends with an error
+        prefetcher.stop()
+        response_box.stop()
+        trace.close()
     # And the experiment is over!
     hrl.close()
     print "Session complete"
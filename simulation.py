@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Headless version of the lightness matching experiment. experiment.main runs
+with a stand-in for hrl that renders into offscreen textures and a simulated
+observer that presses the response box buttons until the match patch has
+the luminance predicted by a model of the illusion strength. Sessions run at
+full speed and report the time spent in each stage of a trial. The result
+files have the layout of exp_data, so the simulation can also generate
+synthetic data sets for the analysis scripts:
+
+    python simulation.py sim_data s1 s2 s3
+"""
+
+import os
+import sys
+import time
+import zlib
+import threading
+import numpy as np
+
+import experiment
+# experiment.py puts the code directory on the path
+import analyze_noise_data
+
+class OffscreenTexture(object):
+    def __init__(self, array):
+        self.array = np.array(array)
+        self.hght, self.wdth = self.array.shape[:2]
+
+    def draw(self, pos, size=None):
+        pass
+
+class OffscreenGraphics(object):
+    """Stand-in for hrl.graphics that keeps textures in memory"""
+
+    def __init__(self):
+        self.n_textures = 0
+        self.n_flips = 0
+
+    def newTexture(self, array, shape='square'):
+        self.n_textures += 1
+        return OffscreenTexture(array)
+
+    def flip(self, clr=True):
+        self.n_flips += 1
+
+class OffscreenInputs(object):
+    def readButton(self, to):
+        return (None, 0)
+
+    def checkEscape(self):
+        return False
+
+class SimulatedHRL(object):
+    """Stand-in for the hrl object of experiment.py. The results are written
+    like hrl.writeResultLine() does, the response box is the observer."""
+
+    def __init__(self, result_fn, result_headers, observer):
+        self.graphics = OffscreenGraphics()
+        self.inputs = OffscreenInputs()
+        self.datapixx = observer
+        self.results = {}
+        self.result_headers = result_headers
+        result_dir = os.path.dirname(result_fn)
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        self.result_file = open(result_fn, 'w')
+        self.result_file.write(' '.join(result_headers) + '\n')
+
+    def writeResultLine(self):
+        self.result_file.write(' '.join(str(self.results[header]) for header
+            in self.result_headers) + '\n')
+        self.result_file.flush()
+
+    def close(self):
+        self.result_file.close()
+
+class SimulatedObserver(object):
+    """Response box of an observer whose illusion strength (in cd/m^2)
+    follows analyze_noise_data.inverted_gaussian of the noise frequency, with
+    the dip at center_ratio times the grating frequency. For each trial, the
+    observer presses the buttons that bring the match patch from its initial
+    luminance closest to the predicted match, plus matching noise with
+    standard deviation sd, and confirms it. Like the DATAPixx, the observer
+    stamps its presses with its own clock, which starts at 0 when the
+    observer is created."""
+
+    def __init__(self, baseline=4., minimum=.5, width=2., center_ratio=8.,
+            sd=.02, seed=None):
+        self.baseline = baseline
+        self.minimum = minimum
+        self.width = width
+        self.center_ratio = center_ratio
+        self.sd = sd
+        self.rng = np.random.RandomState(seed)
+        self.presses = []
+        self.target = None
+        self.lock = threading.Lock()
+        self.clock_start = time.time()
+
+    def illusion_strength(self, noise_type, noise_freq, grating_freq):
+        if noise_type == 'none':
+            return self.baseline
+        return analyze_noise_data.inverted_gaussian(noise_freq,
+                self.center_ratio * grating_freq, self.baseline, self.width,
+                self.minimum)
+
+    def start_trial(self, dsgn, grating_freq):
+        """Choose the match luminance for a trial. The button presses are
+        planned by start_adjustment, once the initial luminance of the match
+        patch is known."""
+        grating_vals = [float(v) for v in dsgn['grating_vals'].split(',')]
+        coaxial_lum = grating_vals[(experiment.n_bars / 2) % 2]
+        strength = self.illusion_strength(dsgn['noise_type'],
+                float(dsgn['noise_freq']), float(grating_freq))
+        # increments (coaxial_lum -1) look brighter than decrements
+        target = (float(dsgn['test_lum']) - coaxial_lum * strength / 2 / 88 +
+                self.rng.normal(0, self.sd))
+        with self.lock:
+            self.target = min(max(target, 0), 1)
+            self.presses = []
+
+    def start_adjustment(self, match_initial):
+        """Plan the button presses from the initial luminance of the match
+        patch, replaces experiment.start_adjustment"""
+        with self.lock:
+            self.presses = self.plan(match_initial)
+
+    def plan(self, match_lum):
+        """Buttons that move match_lum to the target in the step sizes of
+        experiment.adjust_loop, and confirm it"""
+        presses = []
+        while abs(self.target - match_lum) > .005:
+            diff = self.target - match_lum
+            if abs(diff) > .025:
+                presses.append('Up' if diff > 0 else 'Down')
+                match_lum += .05 if diff > 0 else -.05
+            else:
+                presses.append('Right' if diff > 0 else 'Left')
+                match_lum += .01 if diff > 0 else -.01
+        # end the adjustment and confirm the match
+        return presses + ['Space', 'Space', 'Space']
+
+    def readButton(self):
+        """Response box interface used by experiment.ResponseBox"""
+        with self.lock:
+            if not self.presses:
+                return None
+            btn = self.presses.pop(0)
+        codes = dict((name, code) for code, name in
+                experiment.button_names.items())
+        return (codes[btn], time.time() - self.clock_start)
+
+class FastClock(object):
+    """Replaces the time module in experiment.py, to skip the pauses in the
+    presentation. Short sleeps, like the polling of the response box, are
+    kept."""
+    time = staticmethod(time.time)
+
+    def __init__(self, max_sleep=.01):
+        self.max_sleep = max_sleep
+
+    def sleep(self, seconds):
+        if seconds <= self.max_sleep:
+            time.sleep(seconds)
+
+class StageTimer(object):
+    """Collects the durations of the stages of the trials"""
+
+    def __init__(self):
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            t = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.durations.setdefault(stage, []).append(
+                            time.time() - t)
+        return timed
+
+    def report(self):
+        lines = ['%-10s %6s %10s %10s %10s' % ('stage', 'n', 'total [s]',
+            'mean [ms]', 'max [ms]')]
+        for stage, durations in sorted(self.durations.items()):
+            durations = np.array(durations)
+            lines.append('%-10s %6d %10.2f %10.2f %10.2f' % (stage,
+                len(durations), durations.sum(), durations.mean() * 1000,
+                durations.max() * 1000))
+        return '\n'.join(lines)
+
+def prepare_session(data_dir, vp_id, grating_contrast, grating_freq,
+        session_dir='simulation'):
+    """Create the design of a simulated subject. The result file is stored
+    in data_dir in the layout of exp_data, the design, check and trace files
+    in session_dir. Returns the session tuple of experiment.prepare_files."""
+    design_fn = os.path.join(session_dir, 'design',
+            'narrowband_noise_%s_c%1.1f_sf%s.csv' % (vp_id, grating_contrast,
+                grating_freq))
+    result_fn = os.path.join(data_dir, vp_id, 'sf_%s' % grating_freq,
+            'contrast%i' % (grating_contrast * 10),
+            'noise_matching_%s_1.csv' % vp_id)
+    check_fn = os.path.join(session_dir, 'check_files', vp_id,
+            'sf_%s' % grating_freq, 'contrast%d' % (grating_contrast * 10),
+            'noise_matching_1.csv')
+    for fn in [design_fn, check_fn]:
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+    total_trials = experiment.create_design(design_fn, grating_freq)
+    return (design_fn, result_fn, 0, total_trials, check_fn,
+            grating_contrast, grating_freq, 1, None)
+
+def simulate(data_dir, vp_id, grating_contrast=.1, grating_freq='.4',
+        observer=None, session_dir='simulation'):
+    """Run a complete session of a simulated observer at full speed and
+    return the StageTimer with the durations of prepare (stimulus creation
+    on the prefetch thread), upload (texture creation), trial (run_trial),
+    write (result line) and index (session index update)."""
+    if observer is None:
+        observer = SimulatedObserver()
+    timer = StageTimer()
+    session = prepare_session(data_dir, vp_id, grating_contrast,
+            grating_freq, session_dir)
+    run_trial = experiment.run_trial
+
+    def observed_trial(dsgn, *args, **kwargs):
+        observer.start_trial(dsgn, grating_freq)
+        return run_trial(dsgn, *args, **kwargs)
+
+    def create_hrl(design_fn, result_fn, result_headers):
+        hrl = SimulatedHRL(result_fn, result_headers, observer)
+        hrl.graphics.newTexture = timer.wrap('upload',
+                hrl.graphics.newTexture)
+        hrl.writeResultLine = timer.wrap('write', hrl.writeResultLine)
+        return hrl
+
+    patched = {'prepare_stimulus': timer.wrap('prepare',
+                   experiment.prepare_stimulus),
+               'run_trial': timer.wrap('trial', observed_trial),
+               'start_adjustment': observer.start_adjustment,
+               'write_session_index': timer.wrap('index',
+                   experiment.write_session_index),
+               # no fonts are needed to draw text offscreen
+               'draw_text': lambda text, bg=.5, text_color=0, fontsize=48:
+                   np.ones((fontsize, fontsize * len(text))) * bg,
+               'time': FastClock()}
+    originals = dict((name, getattr(experiment, name)) for name in patched)
+    try:
+        for name, value in patched.items():
+            setattr(experiment, name, value)
+        experiment.main(session, create_hrl, intro=False)
+    finally:
+        for name, value in originals.items():
+            setattr(experiment, name, value)
+    return timer
+
+if __name__ == '__main__':
+    data_dir = sys.argv[1]
+    for vp_id in sys.argv[2:] or ['sim']:
+        # a stable seed per subject, unlike hash() with hash randomization
+        seed = zlib.crc32(vp_id) & 0xffffffff
+        for grating_freq in ['.2', '.4', '.8']:
+            timer = simulate(data_dir, vp_id, grating_freq=grating_freq,
+                    observer=SimulatedObserver(seed=seed))
+            print(timer.report())